@@ -1,23 +1,27 @@
 import math
-from model import CLBert
+import functools
+from model import CLBert, forward_views
 from init_parameter import init_model
 from dataloader import Data
 from mtp import PretrainModelManager
 from utils.tools import *
-from utils.memory import MemoryBank, fill_memory_bank
-from utils.neighbor_dataset import NeighborsDataset
+from utils.memory import MemoryBank, FeatureQueue, fill_memory_bank, fill_memory_bank_from_features
+from utils.amp import get_training_step, cast_weights
+from utils.clustering import get_clustering_stage, sub_kmeans_centers
+from utils.batching import LengthBucketSampler, get_loader_kwargs
+from utils.neighbor_dataset import NeighborsDataset, neighbor_collate
 from model import BertForModel
 from model import DistillLoss
 from transformers import logging, WEIGHTS_NAME
 from torch.utils.data import DataLoader
-from torch.utils.data._utils.collate import default_collate
 import warnings
 from scipy.spatial import distance as dist
 from sklearn.neighbors import NearestNeighbors
 import re
 import time
-import openai
-from together import Together
+from utils.llm import chat_completion, run_concurrently
+from utils.llm_cache import get_llm_cache
+from utils.llm_telemetry import get_llm_telemetry
 warnings.filterwarnings('ignore')
 logging.set_verbosity_error()
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -36,36 +40,35 @@ class ModelManager:
         
         # Pretraining
         if pretrained_model is None:
-            pretrained_model = BertForModel(args.pretrain_dir, num_labels=data.n_known_cls)
+            pretrained_model = BertForModel(args.pretrain_dir, num_labels=data.n_known_cls, attn_implementation=args.attn_implementation)
             # if os.path.exists(args.pretrain_dir):
             #     pretrained_model = self.restore_model(args, pretrained_model)
         self.pretrained_model = pretrained_model
         self.load_pretrained_model()
+        # fp32 master weights are taken before the cast, so they keep the unrounded (pre)trained weights
+        self.master_weights = cast_weights(self.model, torch.bfloat16, keep_fp32=args.fp32_master_weights) if args.bf16_weights else None
         
         if args.cluster_num_factor > 1:
             self.num_labels = self.predict_k(args, data) 
         else:
             self.num_labels = data.num_labels
         
-        self.num_train_optimization_steps = int(len(data.train_semi_dataset) / args.train_batch_size) * args.num_train_epochs
+        self.train_clustering = get_clustering_stage(args, self.num_labels, name='train')
+        self.test_clustering = get_clustering_stage(args, self.num_labels, name='test')
+
+        self.num_train_optimization_steps = math.ceil(int(len(data.train_semi_dataset) / args.train_batch_size) / args.grad_accum_steps) * args.num_train_epochs
         
         self.optimizer, self.scheduler = self.get_optimizer(args)
+        self.training_step = get_training_step(args, self.optimizer, self.scheduler, self.device, args.grad_clip, master_weights=self.master_weights)
+        self.neg_queue = FeatureQueue(args.neg_queue_size, self.device) if args.neg_queue_size > 0 else None
         
-        self.tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        self.tokenizer = data.tokenizer
         self.generator = view_generator(self.tokenizer, args.rtr_prob, args.seed)
+        self.special_tokens_mask = data.semi_special_tokens_mask.to(self.device)
         args.num_training_rounds = math.ceil(args.num_train_epochs / args.update_per_epoch)
         args.current_training_round = 0
         print('\nNumber of Training Rounds: ', args.num_training_rounds)
 
-    def custom_collate(self, batch):
-        batch_dict = {}
-        for key in batch[0]:
-            if key in ['pos_cluster_idx', 'neg_cluster_idx']:
-                batch_dict[key] = [d[key] for d in batch]
-            else:
-                batch_dict[key] = default_collate([d[key] for d in batch])
-        return batch_dict
-
     def get_neighbor_dataset(self, args, data, indices, query_index, pred, p, cluster_name=None, init=False):
         if init or not args.feedback_cache:
             self.di_all, self.di_all_pos_cluster_idx, self.di_all_neg_cluster_idx = {}, {}, {}
@@ -79,30 +82,58 @@ class ModelManager:
         print('\n Number of Loaded LLM feedback: ', len(self.di_all))
 
         dataset = NeighborsDataset(args, data.train_semi_dataset, indices, query_index, pred, p, cluster_name=cluster_name,
-                                   di_all=self.di_all, di_all_pos_cluster_idx=self.di_all_pos_cluster_idx, di_all_neg_cluster_idx=self.di_all_neg_cluster_idx)
-        self.train_dataloader = DataLoader(dataset, batch_size=args.train_batch_size, shuffle=True, collate_fn=self.custom_collate)
+                                   di_all=self.di_all, di_all_pos_cluster_idx=self.di_all_pos_cluster_idx, di_all_neg_cluster_idx=self.di_all_neg_cluster_idx,
+                                   tokenizer=data.tokenizer)
+        # the feedback is resolved before iteration, so the items can be fetched and collated in worker processes
+        collate_fn = functools.partial(neighbor_collate, dynamic_padding=args.dynamic_padding)
+        if args.length_bucketing:
+            batch_sampler = LengthBucketSampler(data.semi_input_mask.sum(dim=1).numpy(), args.train_batch_size, shuffle=True,
+                                                bucket_size_multiplier=args.bucket_size_multiplier)
+            self.train_dataloader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, **get_loader_kwargs(args))
+        else:
+            self.train_dataloader = DataLoader(dataset, batch_size=args.train_batch_size, shuffle=True, collate_fn=collate_fn, **get_loader_kwargs(args))
         self.dataset = dataset
 
-    def get_neighbor_inds(self, args, data, km):
+    def get_neighbor_inds(self, args, data, km, feats=None, labels=None):
         memory_bank = MemoryBank(args, len(data.train_semi_dataset), args.feat_dim, len(data.all_label_list), 0.1)
-        fill_memory_bank(data.train_semi_dataloader, self.model, memory_bank)
+        if feats is None:
+            fill_memory_bank(data.train_semi_dataloader, self.model, memory_bank)
+        else:
+            # reuse the embeddings of this round instead of another forward pass over the training set
+            fill_memory_bank_from_features(feats, labels, memory_bank)
         indices, query_index, p = memory_bank.mine_nearest_neighbors(args.topk, km.labels_, km.cluster_centers_)
         return indices, query_index, p
     
-    def get_adjacency(self, args, inds, neighbors, targets):
-        """get adjacency matrix"""
-        adj = torch.zeros(inds.shape[0], inds.shape[0])
-        for b1, n in enumerate(neighbors):
-            adj[b1][b1] = 1
-            for b2, j in enumerate(inds):
-                if j in n:
-                    adj[b1][b2] = 1 # if in neighbors
-                # if (targets[b1] == targets[b2]) and (targets[b1]>=0) and (targets[b2]>=0):
-                if (targets[b1] == targets[b2]) and (inds[b1] <= args.num_labeled_examples) and (inds[b2] <= args.num_labeled_examples):
-                    adj[b1][b2] = 1 # if same labels
-                    # this is useful only when both have labels
-                    # how to ensure there is no label leakage for unlabeled data? inds[b1] <= args.num_labeled_examples?
-        return adj
+    def get_adjacency(self, args, inds, neighbors, targets, key_inds=None, key_targets=None):
+        """
+        get adjacency matrix (bz, bz) on the training device with broadcast comparisons,
+        or (bz, n_keys) between the batch and other samples (e.g. the feature queue) given key_inds and key_targets
+        """
+        inds = inds.to(self.device)
+        neighbors = neighbors.to(self.device)
+        targets = targets.to(self.device)
+        keys = inds if key_inds is None else key_inds.to(self.device)
+        key_targets = targets if key_targets is None else key_targets.to(self.device)
+
+        # adj[b1][b2] = 1 if inds[b2] is one of the neighbors of b1: scatter the neighbors into a (bz, n) membership mask
+        # over the sample indices and read the key columns, instead of a (bz, n_keys, topk) comparison
+        n = int(torch.max(neighbors.max(), keys.max())) + 1
+        is_neighbor = torch.zeros(len(inds), n, dtype=torch.bool, device=self.device)
+        is_neighbor.scatter_(1, neighbors.long(), True)
+        adj = is_neighbor[:, keys]
+
+        # adj[b1][b2] = 1 if same labels, only when both have labels
+        # how to ensure there is no label leakage for unlabeled data? inds[b1] <= args.num_labeled_examples?
+        labeled = inds <= args.num_labeled_examples
+        key_labeled = keys <= args.num_labeled_examples
+        same_target = targets.unsqueeze(1) == key_targets.unsqueeze(0)
+        adj |= same_target & labeled.unsqueeze(1) & key_labeled.unsqueeze(0)
+
+        if key_inds is None:
+            adj.fill_diagonal_(True)
+        else:
+            adj |= inds.unsqueeze(1) == keys.unsqueeze(0)
+        return adj.float()
 
     def evaluation(self, args, data, save_results=True, plot_cm=True):
         """final clustering evaluation on test set"""
@@ -112,10 +143,11 @@ class ModelManager:
         feats_test = feats_test.cpu().numpy()
 
         # clustering result
-        km = KMeans(n_clusters = self.num_labels, random_state=args.seed).fit(feats_test)
+        km = self.test_clustering.fit(feats_test)
         y_pred = km.labels_
         y_true = labels.cpu().numpy()
         results = clustering_score(y_true, y_pred, data.known_lab)
+        results['KMeans_Time'] = round(km.fit_time, 2)
         print('results',results)
         self.test_results = results
 
@@ -130,9 +162,11 @@ class ModelManager:
         if isinstance(self.model, nn.DataParallel):
             criterion = self.model.module.loss_cl
             ce = self.model.module.loss_ce
+            cluster_instance = self.model.module.loss_cluster_instance
         else:
             criterion = self.model.loss_cl
             ce = self.model.loss_ce
+            cluster_instance = self.model.loss_cluster_instance
 
         if args.weight_ce_unsup > 0:
             cluster_criterion = DistillLoss(
@@ -142,17 +176,19 @@ class ModelManager:
                                 args.teacher_temp,
                             )
             
-        # Obtain initial features, labels, logits
+        # Obtain initial features, labels, logits: one embedding snapshot per round shared by
+        # K-Means, category characterization and the memory bank for neighbor mining
         feats_gpu, labels, logits = self.get_features_labels(data.train_semi_dataloader, self.model, args, return_logit=True)
         feats = feats_gpu.cpu().numpy()
 
         # Perform K-Means Clustering and extract cluster centers
-        km = KMeans(n_clusters = self.num_labels, random_state=args.seed).fit(feats)
+        km = self.train_clustering.fit(feats)
 
         # Category Characterization
         if self.args.weight_cluster_instance_cl > 0:
             cluster_name = self.category_characterization(data, km, feats_gpu)
             print('len(cluster_name)',len(cluster_name))
+            self.set_cluster_descriptions(cluster_name)
 
             label_names = list(args.label_map_semi.keys())
             print('label_names',label_names)   
@@ -162,22 +198,27 @@ class ModelManager:
         # Get Neighbor Dataset
         args.current_training_round += 1
         print('\nCurrent Training Round: ', args.current_training_round)
-        indices, query_index, p = self.get_neighbor_inds(args, data, km)
+        indices, query_index, p = self.get_neighbor_inds(args, data, km, feats_gpu, labels)
         self.get_neighbor_dataset(args, data, indices, query_index, km.labels_, p, cluster_name=cluster_name, init=True)
 
 
         # Training
-        labelediter = iter(data.train_labeled_dataloader)
+        self.labelediter = iter(data.train_labeled_dataloader)
+        global_step = 0
         for epoch in range(int(args.num_train_epochs)):
             print(f'\n\nTraining Epoch: [{epoch+1}/{args.num_train_epochs}]')
             self.model.train()
             tr_loss = 0
             nb_tr_examples, nb_tr_steps = 0, 0
 
+            # data stall: time each step waits for the dataloader, i.e. for NeighborsDataset.__getitem__ and the collate function
+            data_stalls, epoch_start = [], time.time()
+            fetch_start = epoch_start
             for _, batch in enumerate(self.train_dataloader):
+                data_stalls.append(time.time() - fetch_start)
                 # 1. load data
-                anchor = tuple(t.to(self.device) for t in batch["anchor"]) # anchor data
-                neighbor = tuple(t.to(self.device) for t in batch["neighbor"]) # neighbor data
+                anchor = tuple(t.to(self.device, non_blocking=args.pin_memory) for t in batch["anchor"]) # anchor data
+                neighbor = tuple(t.to(self.device, non_blocking=args.pin_memory) for t in batch["neighbor"]) # neighbor data
                 pos_neighbors = batch["possible_neighbors"] # all possible neighbor inds for anchor
                 data_inds = batch["index"] # data ind
 
@@ -185,14 +226,17 @@ class ModelManager:
                 adjacency = self.get_adjacency(args, data_inds, pos_neighbors, batch["target"]) # (bz,bz)
 
                 # 3. get augmentations
+                # special tokens of the anchors and neighbors, precomputed for the whole training set
+                an_special = self.special_tokens_mask[batch["index"].to(self.device), :anchor[0].size(1)]
+                ng_special = self.special_tokens_mask[batch["neighbor_index"].to(self.device), :neighbor[0].size(1)]
                 if args.view_strategy == "rtr":
-                    X_an = {"input_ids":self.generator.random_token_replace(anchor[0].cpu()).to(self.device), "attention_mask":anchor[1], "token_type_ids":anchor[2]}
-                    X_ng = {"input_ids":self.generator.random_token_replace(neighbor[0].cpu()).to(self.device), "attention_mask":neighbor[1], "token_type_ids":neighbor[2]}
-                    X_an_2 = {"input_ids":self.generator.random_token_replace(anchor[0].cpu()).to(self.device), "attention_mask":anchor[1], "token_type_ids":anchor[2]}
+                    X_an = {"input_ids":self.generator.random_token_replace(anchor[0], an_special), "attention_mask":anchor[1], "token_type_ids":anchor[2]}
+                    X_ng = {"input_ids":self.generator.random_token_replace(neighbor[0], ng_special), "attention_mask":neighbor[1], "token_type_ids":neighbor[2]}
+                    X_an_2 = {"input_ids":self.generator.random_token_replace(anchor[0], an_special), "attention_mask":anchor[1], "token_type_ids":anchor[2]}
                 elif args.view_strategy == "shuffle":
-                    X_an = {"input_ids":self.generator.shuffle_tokens(anchor[0].cpu()).to(self.device), "attention_mask":anchor[1], "token_type_ids":anchor[2]}
-                    X_ng = {"input_ids":self.generator.shuffle_tokens(neighbor[0].cpu()).to(self.device), "attention_mask":neighbor[1], "token_type_ids":neighbor[2]}
-                    X_an_2 = {"input_ids":self.generator.shuffle_tokens(anchor[0].cpu()).to(self.device), "attention_mask":anchor[1], "token_type_ids":anchor[2]}
+                    X_an = {"input_ids":self.generator.shuffle_tokens(anchor[0], an_special), "attention_mask":anchor[1], "token_type_ids":anchor[2]}
+                    X_ng = {"input_ids":self.generator.shuffle_tokens(neighbor[0], ng_special), "attention_mask":neighbor[1], "token_type_ids":neighbor[2]}
+                    X_an_2 = {"input_ids":self.generator.shuffle_tokens(anchor[0], an_special), "attention_mask":anchor[1], "token_type_ids":anchor[2]}
                 elif args.view_strategy == "none":
                     X_an = {"input_ids":anchor[0], "attention_mask":anchor[1], "token_type_ids":anchor[2]}
                     X_ng = {"input_ids":neighbor[0], "attention_mask":neighbor[1], "token_type_ids":neighbor[2]}
@@ -201,15 +245,28 @@ class ModelManager:
                     raise NotImplementedError(f"View strategy {args.view_strategy} not implemented!")
                 
                 # 4. compute loss and update parameters
-                with torch.set_grad_enabled(True):
+                with torch.set_grad_enabled(True), self.training_step.autocast():
                     pstr = ''
-                    out_an = self.model(X_an)
-                    out_ng = self.model(X_ng)
-                    out_an_2 = self.model(X_an_2)
+                    if args.fused_forward:
+                        # one forward over the three views and the labeled batch
+                        X_lab, label_lab = self.next_labeled_batch(data)
+                        out_an, out_ng, out_an_2, out_lab = forward_views(self.model, [X_an, X_ng, X_an_2, X_lab], fused=True)
+                    else:
+                        out_an = self.model(X_an)
+                        out_ng = self.model(X_ng)
+                        out_an_2 = self.model(X_an_2)
 
                     ## Contrastive Loss
                     f_pos = torch.stack([out_an["features"], out_ng["features"]], dim=1) # shape required by SupConLoss: [bs, n_views, feat_dim]
-                    loss_cl = criterion(f_pos, mask=adjacency, temperature=args.temp)
+                    if self.neg_queue is not None and self.neg_queue.filled > 0:
+                        # anchors of previous steps as extra contrast samples, positives by the same neighbor and label rules
+                        queue, queue_inds, queue_targets = self.neg_queue.get()
+                        queue_mask = self.get_adjacency(args, data_inds, pos_neighbors, batch["target"], key_inds=queue_inds, key_targets=queue_targets)
+                        loss_cl = criterion(f_pos, mask=adjacency, temperature=args.temp, queue=queue, queue_mask=queue_mask)
+                    else:
+                        loss_cl = criterion(f_pos, mask=adjacency, temperature=args.temp)
+                    if self.neg_queue is not None:
+                        self.neg_queue.enqueue(out_an["features"], data_inds, batch["target"])
 
                     loss_cl_cluster_instance = 0
                     # Cluster-Instance Alignment Loss
@@ -217,46 +274,17 @@ class ModelManager:
                         pos_cluster_idx_noisy = batch["pos_cluster_idx"] # positive cluster description
                         neg_cluster_idx_noisy = batch["neg_cluster_idx"] # negative cluster description
                         
-                        # only take valid cluster idx: None is invalid
-                        pos_cluster_idx = [i for i in pos_cluster_idx_noisy if i is not None]
-                        neg_cluster_idx = [i for i in neg_cluster_idx_noisy if i is not None]
-
-                        # tokenize all cluster descriptions
-                        all_cluster_des_t =  self.tokenizer(cluster_name, padding=True, truncation=True, return_tensors="pt", max_length=64) # shape: [num_clusters, seq_len]
-
-                        # Feed all cluster descriptions at once to the model
-                        X_all_cluster_des = {
-                            "input_ids": all_cluster_des_t["input_ids"].to(self.device), 
-                            "attention_mask": all_cluster_des_t["attention_mask"].to(self.device), 
-                            "token_type_ids": all_cluster_des_t["token_type_ids"].to(self.device)
-                        }
-                        feat_all_cluster_des = self.model(X_all_cluster_des)["features"]
+                        # only take the features corresponding to query with valid cluster descriptions: None is invalid
+                        valid = [i for i in range(len(pos_cluster_idx_noisy)) if pos_cluster_idx_noisy[i] is not None]
 
-                        # only take the features corresponding to query with valid cluster descriptions
-                        an_w_cluster_des_feat = out_an["features"] 
-                        an_w_cluster_des_feat = an_w_cluster_des_feat[[i for i in range(len(pos_cluster_idx_noisy)) if pos_cluster_idx_noisy[i] is not None]] # torch.Size([..., 768])
-
-                        pos_cluster_feat = [feat_all_cluster_des[i] for i in pos_cluster_idx]   # torch.Size([768]) x ...
-                        neg_cluster_feat = [feat_all_cluster_des[i] for i in neg_cluster_idx]   # torch.Size([..., 768]) x ...
+                        # encode all cluster descriptions at once, or reuse their cached features
+                        feat_all_cluster_des = self.encode_cluster_descriptions(global_step)
 
                         # compute cluster description and instance alignment loss
-                        if len(an_w_cluster_des_feat) > 0 and len(pos_cluster_feat) > 0:              
-                            for i in range(len(an_w_cluster_des_feat)):
-                                # compute similarity scores
-                                sim_positive = F.cosine_similarity(an_w_cluster_des_feat[i].unsqueeze(0), pos_cluster_feat[i].unsqueeze(0), dim=1) / args.temp
-                                sim_negatives = F.cosine_similarity(an_w_cluster_des_feat[i].unsqueeze(0), neg_cluster_feat[i], dim=1) / args.temp
-                                
-                                # calculate the numerator (similarity of positive pair)
-                                numerator = torch.exp(sim_positive)
-
-                                # calculate the denominator (sum of similarities with all negatives)
-                                denominator = torch.exp(sim_negatives).sum()
-
-                                # compute the alignment loss
-                                loss = -torch.log(numerator / denominator)
-                                loss_cl_cluster_instance += loss
-                            # normalize the loss
-                            loss_cl_cluster_instance /= len(an_w_cluster_des_feat)
+                        if len(valid) > 0:
+                            loss_cl_cluster_instance = cluster_instance(out_an["features"][valid], feat_all_cluster_des,
+                                                                        [pos_cluster_idx_noisy[i] for i in valid],
+                                                                        [neg_cluster_idx_noisy[i] for i in valid], temperature=args.temp)
 
 
                     ## Parametric Classification Loss
@@ -275,16 +303,10 @@ class ModelManager:
 
 
                     # Supervised Classification Loss for Labeled Data
-                    try:
-                        batch = next(labelediter)
-                    except StopIteration:
-                        labelediter = iter(data.train_labeled_dataloader)
-                        batch = next(labelediter)
-                    batch = tuple(t.to(self.device) for t in batch)
-                    X_an = {"input_ids":batch[0], "attention_mask":batch[1], "token_type_ids":batch[2]}
-
-                    logits = self.model(X_an)["logits"]
-                    loss_ce_sup = ce(logits, batch[3])
+                    if not args.fused_forward:
+                        X_lab, label_lab = self.next_labeled_batch(data)
+                        out_lab = self.model(X_lab)
+                    loss_ce_sup = ce(out_lab["logits"], label_lab)
 
 
                     loss_ce = args.sup_weight * loss_ce_sup 
@@ -297,21 +319,27 @@ class ModelManager:
                     pstr += f'loss_cl_cluster_instance: {loss_cl_cluster_instance.item():.2f} ' if loss_cl_cluster_instance != 0 else ""
                     pstr += f'loss: {loss.item():.2f} '
 
-                    tr_loss += loss.item()
-                    
-                    loss.backward()
-                    nn.utils.clip_grad_norm_(self.model.parameters(), args.grad_clip)
-                    self.optimizer.step()
-                    self.scheduler.step()
-                    self.optimizer.zero_grad()
-                    nb_tr_examples += anchor[0].size(0)
-                    nb_tr_steps += 1
+                tr_loss += loss.item()
 
-                    if _ % args.print_freq == 0:
-                        print(pstr)
+                # backward outside autocast, the optimizer steps every args.grad_accum_steps batches
+                self.training_step.backward(loss)
+                nb_tr_examples += anchor[0].size(0)
+                nb_tr_steps += 1
+                global_step += 1
 
+                if _ % args.print_freq == 0:
+                    print(pstr)
+                fetch_start = time.time()
+
+            self.training_step.flush()
             loss = tr_loss / nb_tr_steps
             print('train_loss',loss)
+            data_stalls = np.array(data_stalls) * 1000
+            print(f'Data stall per step (num_workers: {args.num_workers}): mean {data_stalls.mean():.1f}ms, p50 {np.percentile(data_stalls, 50):.1f}ms, '
+                  f'p90 {np.percentile(data_stalls, 90):.1f}ms, max {data_stalls.max():.1f}ms, total {data_stalls.sum() / 1000:.2f}s of {time.time() - epoch_start:.2f}s epoch time')
+            if args.weight_cluster_instance_cl > 0:
+                cluster_des_time = self.pop_cluster_des_time()
+                print(f'Cluster description encoding ({args.cluster_des_encode}): {cluster_des_time:.2f}s in {nb_tr_steps} steps, {cluster_des_time / nb_tr_steps * 1000:.1f}ms/step')
             self.dataset.count = 0
             
             args.evaluation_epoch = epoch
@@ -319,18 +347,20 @@ class ModelManager:
             if ((epoch + 1) % args.update_per_epoch) == 0 and ((epoch + 1) != int(args.num_train_epochs)):
                 self.evaluation(args, data, save_results=True, plot_cm=False)
 
-                # Obtain initial features, labels, logits
+                # Obtain features, labels, logits: one embedding snapshot per round shared by
+                # K-Means, category characterization and the memory bank for neighbor mining
                 feats_gpu, labels, logits = self.get_features_labels(data.train_semi_dataloader, self.model, args, return_logit=True)
                 feats = feats_gpu.cpu().numpy()
 
-                # Perform K-Means Clustering and extract cluster centers
-                km = KMeans(n_clusters = self.num_labels, random_state=args.seed).fit(feats)
+                # Perform K-Means Clustering and extract cluster centers, warm-started from the previous round if enabled
+                km = self.train_clustering.fit(feats)
 
                 if self.args.weight_cluster_instance_cl > 0:
                     # Category Characterization
                     cluster_name = self.category_characterization(data, km, feats_gpu)
                     # print('\nAll Category Names and description:', cluster_name)
                     print('len(cluster_name)',len(cluster_name))
+                    self.set_cluster_descriptions(cluster_name)
                     label_names = list(args.label_map_semi.keys())
                     print('label_names',label_names)  
                     measure_interpretability(cluster_name, label_names, args)  
@@ -338,17 +368,85 @@ class ModelManager:
                     cluster_name = None
 
                 # Get Neighbor Dataset
-                indices, query_index, p = self.get_neighbor_inds(args, data, km)
+                indices, query_index, p = self.get_neighbor_inds(args, data, km, feats_gpu, labels)
                 self.get_neighbor_dataset(args, data, indices, query_index, km.labels_, p, cluster_name=cluster_name)
 
 
 
+    def set_cluster_descriptions(self, cluster_name):
+        """tokenize the cluster descriptions once per round and keep the tensors on the device"""
+        all_cluster_des_t = self.tokenizer(cluster_name, padding=True, truncation=True, return_tensors="pt", max_length=64) # shape: [num_clusters, seq_len]
+        self.cluster_des_inputs = {
+            "input_ids": all_cluster_des_t["input_ids"].to(self.device),
+            "attention_mask": all_cluster_des_t["attention_mask"].to(self.device),
+            "token_type_ids": all_cluster_des_t["token_type_ids"].to(self.device)
+        }
+        self.cluster_des_feat = None
+        self.cluster_des_time = 0
+        self.cluster_des_events = []
+
+    def next_labeled_batch(self, data):
+        """next labeled batch for the supervised classification loss, restarting the labeled dataloader when exhausted"""
+        try:
+            batch = next(self.labelediter)
+        except StopIteration:
+            self.labelediter = iter(data.train_labeled_dataloader)
+            batch = next(self.labelediter)
+        batch = tuple(t.to(self.device) for t in batch)
+        X_lab = {"input_ids":batch[0], "attention_mask":batch[1], "token_type_ids":batch[2]}
+        return X_lab, batch[3]
+
+    def encode_cluster_descriptions(self, step):
+        """
+        features of all cluster descriptions according to args.cluster_des_encode:
+        step: re-encode with gradient at every step | every_k: re-encode with gradient every args.cluster_des_encode_every steps
+        and reuse the detached features in between | round: encode once per round without gradient
+        """
+        # timed with CUDA events on the GPU, so the timing does not synchronize every step
+        if torch.cuda.is_available():
+            start_event, end_event = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start_event.record()
+        else:
+            start = time.time()
+        mode = self.args.cluster_des_encode
+        if mode == 'step' or (mode == 'every_k' and (self.cluster_des_feat is None or step % self.args.cluster_des_encode_every == 0)):
+            feat_all_cluster_des = self.model(self.cluster_des_inputs)["features"]
+            self.cluster_des_feat = feat_all_cluster_des.detach()
+        elif mode == 'round' or mode == 'every_k':
+            if self.cluster_des_feat is None:
+                # encode in eval mode, the features are reused for the whole round and should not carry one dropout mask
+                self.model.eval()
+                with torch.no_grad():
+                    self.cluster_des_feat = self.model(self.cluster_des_inputs)["features"]
+                self.model.train()
+            feat_all_cluster_des = self.cluster_des_feat
+        else:
+            raise NotImplementedError(f"Cluster description encoding {mode} not implemented!")
+        if torch.cuda.is_available():
+            end_event.record()
+            self.cluster_des_events.append((start_event, end_event))
+        else:
+            self.cluster_des_time += time.time() - start
+        return feat_all_cluster_des
+
+    def pop_cluster_des_time(self):
+        """seconds spent encoding cluster descriptions since the last call, synchronizes once for the recorded CUDA events"""
+        if len(self.cluster_des_events) > 0:
+            self.cluster_des_events[-1][1].synchronize()
+            self.cluster_des_time += sum(start.elapsed_time(end) for start, end in self.cluster_des_events) / 1000
+            self.cluster_des_events = []
+        cluster_des_time, self.cluster_des_time = self.cluster_des_time, 0
+        return cluster_des_time
+
     def category_characterization(self, data, km, feats_gpu):
         print('\n\n### Category Characterization ###\n')
         print('Sampling Strategy:', self.args.interpret_sampling_strategy)
         print('Number of Representatives:', self.args.interpret_num_representatives)
         print('LLM Interpretation Model:', self.args.llm)
 
+        timings = {}
+        start = time.time()
+
         # Sample representative examples from each cluster
         interpret_num_representatives = self.args.interpret_num_representatives
         cluster_centers = torch.tensor(km.cluster_centers_)
@@ -369,60 +467,67 @@ class ModelManager:
             index = [torch.randperm(len(i))[:interpret_num_representatives] for i in index]
         # 3. Perform sub-clustering using KMeans for each cluster to obtain K sub-clusters and sample 1 samples nearest to each sub-cluster center, similar to the first strategy
         elif self.args.interpret_sampling_strategy == 'nearest_sub_kmeans_centriods':
-            # for each cluster, perform sub-clustering using KMeans
+            members = [torch.where(km_labels == i)[0] for i in range(self.num_labels)]
+            # handle case where there are fewer samples than the number of representatives,
+            # the number of sub-clusters is carried over to the following clusters as in the sequential loop
+            n_sub_clusters = np.minimum.accumulate([interpret_num_representatives] + [len(m) for m in members])[1:].tolist()
+            feats_cpu = feats_gpu.cpu()
+            sub_kmeans_start = time.time()
+            sub_centers = sub_kmeans_centers([feats_cpu[m].numpy() for m in members], n_sub_clusters, self.args.seed,
+                                             workers=self.args.characterization_workers)
             index = []
-            for i in range(self.num_labels):
-                cluster_feats = feats_gpu[km_labels == i]
-                # handle case where there are fewer samples than the number of representatives
-                if cluster_feats.size(0) < interpret_num_representatives:
-                    interpret_num_representatives = cluster_feats.size(0)
-                sub_km = KMeans(n_clusters=interpret_num_representatives, random_state=self.args.seed).fit(cluster_feats.cpu().numpy())
-                sub_cluster_centers = torch.tensor(sub_km.cluster_centers_).to(feats_gpu.device)
-                dis = self.EuclideanDistances(cluster_feats, sub_cluster_centers).T
-                _, sub_index = torch.sort(dis, dim=1)
-                sub_indices = sub_index[:, :1].flatten()
-                original_indices = torch.where(km_labels == i)[0]
-                index.append(original_indices[sub_indices])
+            for m, centers in zip(members, sub_centers):
+                dis = self.EuclideanDistances(feats_cpu[m], torch.tensor(centers)).T
+                index.append(m[torch.argmin(dis, dim=1)])
+            timings['sub_kmeans'] = time.time() - sub_kmeans_start
             print('Sub-Cluster Index:', index)
         else:
             raise NotImplementedError(f"Sampling strategy {self.args.interpret_sampling_strategy} not implemented!")
-
-        # Assign Names and Description to Clusters:
-        cluster_name = []
-        example_count = 0   
-        for i in range(len(index)):
-            query = []
-            for j in index[i]:
-                query.append(data.train_semi_dataset.__getitem__(j)[0])
-            llm_feedback = self.query_llm(query, example_count)
-            cluster_name.append(llm_feedback)
-
-            if example_count < 5:
-                query_text = []
-                query_labels = []
-                for j in index[i]:
-                    query_text.append(self.tokenizer.decode(data.train_semi_dataset.__getitem__(j)[0], skip_special_tokens=True, clean_up_tokenization_spaces=True))
-                    query_label_index = data.train_semi_dataset.__getitem__(j)[3].item()
-                    query_label_name = args.get_label_name_semi[query_label_index]
-                    query_labels.append(query_label_name)
-                print(f'\nCategory Characterization Examples: {i}')
-                print('Query Text:\n', query_text) 
-                print('Query Ground Truth Labels:\n', query_labels)
-                print('LLM Generated Category Name and Description:\n', llm_feedback)
-            example_count += 1
+        # sampling excludes the sub-KMeans fits, so the stages add up to the total
+        timings['sampling'] = time.time() - start - timings.get('sub_kmeans', 0.0)
+
+        # Build the prompts of all clusters in one pass, decoding all representatives with one batch_decode
+        stage_start = time.time()
+        index_lists = [torch.as_tensor(idx).cpu().flatten().tolist() for idx in index]
+        flat_index = [j for idx in index_lists for j in idx]
+        flat_texts = self.tokenizer.batch_decode(data.semi_input_ids[flat_index], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        utterances, offset = [], 0
+        for idx in index_lists:
+            utterances.append(flat_texts[offset:offset + len(idx)])
+            offset += len(idx)
+        prompts = [self.build_characterization_prompt(utts) for utts in utterances]
+        print('\nCluster Interpretation Prompt Example: 0\n', prompts[0])
+        timings['prompts'] = time.time() - stage_start
+
+        # Assign Names and Description to Clusters, with at most args.llm_concurrency requests in flight
+        stage_start = time.time()
+        cluster_name = run_concurrently(self.query_llm, list(zip(prompts, utterances)), self.args.llm_concurrency)
+        timings['llm'] = time.time() - stage_start
+
+        for i in range(min(5, len(index_lists))):
+            query_labels = [args.get_label_name_semi[j] for j in data.semi_label_ids[index_lists[i]].tolist()]
+            print(f'\nCategory Characterization Examples: {i}')
+            print('Query Text:\n', utterances[i])
+            print('Query Ground Truth Labels:\n', query_labels)
+            print('LLM Generated Category Name and Description:\n', cluster_name[i])
 
         self.cluster_reprsentatives = index
 
         # print('\nAll Category Names and description:', cluster_name)
         print('Total Number of category characterization:', len(cluster_name))
+        if get_llm_cache(self.args) is not None:
+            print('LLM Cache:', get_llm_cache(self.args).stats())
         # print('Total Number of words in category characterization:', sum([len(name.split()) for name in cluster_name]))
-        
+
+        timings['total'] = time.time() - start
+        self.characterization_timings = timings
+        print('Category Characterization Timings:', ', '.join(f'{k} {v:.2f}s' for k, v in timings.items()))
+
         return cluster_name
 
 
-    def query_llm(self, query, example_count):
+    def build_characterization_prompt(self, utterances):
         demo_name = str(list(args.label_map_train.keys()))
-        utterances = [self.tokenizer.decode(utt, skip_special_tokens=True, clean_up_tokenization_spaces=True) for utt in query]
 
         # Construct the prompt with any number of utterances
         prompt = f"Given the following utterances and examples of some known category names, return a category name and a short category description to summarize the common {args.task} of these utterances in the format (Category Name: [category_name], Description: [description]) without explanation. \n"
@@ -430,55 +535,15 @@ class ModelManager:
 
         for i, utterance in enumerate(utterances, 1):
             prompt += f"Utterance {i}: {utterance}\n"
+        return prompt
 
-        if example_count < 1:
-            print(f'\nCluster Interpretation Prompt Example: {example_count}\n', prompt)
-
-        openai.api_key = self.args.api_key
+    def query_llm(self, prompt, utterances):
+        """characterize one cluster, failed requests are retried by the shared LLM client"""
         try:
-            if 'gpt' not in self.args.llm:
-                os.environ["TOGETHER_API_KEY"] = self.args.api_key
-                client = Together()
-                max_retries = 5
-                retry_delay = 1  # Wait for 1 seconds before retrying
-                for attempt in range(max_retries):
-                    try:
-                        completion = client.chat.completions.create(
-                            model= self.args.llm,
-                            messages=[
-                                {"role": "system", "content": "You are a helpful assistant."},
-                                {"role": "user", "content": prompt}
-                            ],
-                            temperature=0.0,
-                            top_p=1.0,
-                            n=1,
-                            max_tokens=50
-                        )
-                        return completion.choices[0].message.content
-                        # break  # If successful, break out of the loop
-                    except Exception as e:
-                        if attempt < max_retries - 1:
-                            print(f"Attempt {attempt + 1} failed: {e}. Retrying in {retry_delay} seconds...")
-                            time.sleep(retry_delay)
-                        else:
-                            print(f"Attempt {attempt + 1} failed: {e}. No more retries left.")
-                            raise e # If all attempts fail, raise the last exception   
-                        
-            else:
-                completion = openai.ChatCompletion.create(
-                    model= self.args.llm, #'gpt-4o-mini', # "gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.0,  # Set to 0 to remove randomness
-                    top_p=1.0,        # Use top_p sampling with the full range of tokens
-                    n=1,               # Number of responses to generate
-                    max_tokens=50     # Set a lower max_tokens value to limit response length and avoid timeout
-                )
-                return completion.choices[0].message['content']
+            return chat_completion(self.args, prompt, site='characterization')
         except Exception as e:
             print(f"LLM query failed with exception: {e}")
+            get_llm_telemetry(self.args).record_fallback('characterization')
             # Return the first three utterances as a fallback
             fallback_text = " | ".join(utterances[:3])
             return f"Fallback Description: {fallback_text}"
@@ -499,36 +564,20 @@ class ModelManager:
         return optimizer, scheduler
     
     def load_pretrained_model(self):
-        """load the backbone of pretrained model"""
+        """load the encoder of pretrained model, the MLM head of the pretrained backbone is not used by CLBert"""
         if isinstance(self.pretrained_model, nn.DataParallel):
-            pretrained_dict = self.pretrained_model.module.backbone.state_dict()
+            pretrained_dict = self.pretrained_model.module.backbone.base_model.state_dict()
         else:
-            pretrained_dict = self.pretrained_model.backbone.state_dict()
+            pretrained_dict = self.pretrained_model.backbone.base_model.state_dict()
         if isinstance(self.model, nn.DataParallel):
             self.model.module.backbone.load_state_dict(pretrained_dict, strict=False)
         else:
             self.model.backbone.load_state_dict(pretrained_dict, strict=False)
 
     def get_features_labels(self, dataloader, model, args, return_logit=False):
-        model.eval()
-        total_features = torch.empty((0,args.feat_dim)).to(self.device)
-        total_labels = torch.empty(0,dtype=torch.long).to(self.device)
-        total_logits = torch.empty((0,self.num_labels)).to(self.device)
-
-        for _, batch in enumerate(dataloader):
-            batch = tuple(t.to(self.device) for t in batch)
-            input_ids, input_mask, segment_ids, label_ids = batch
-            X = {"input_ids":input_ids, "attention_mask": input_mask, "token_type_ids": segment_ids}
-            with torch.no_grad():
-                outputs = model(X, output_hidden_states=True)
-                feature = outputs["hidden_states"]
-                logit = outputs['logits']
-                # feature = model(X, output_hidden_states=True)["hidden_states"]
-
-            total_features = torch.cat((total_features, feature))
-            total_labels = torch.cat((total_labels, label_ids))
-            total_logits = torch.cat((total_logits, logit))
-
+        total_features, total_labels, total_logits = extract_features(model, dataloader, self.device, feat_dim=args.feat_dim,
+                                                                      num_logits=self.num_labels if return_logit else None,
+                                                                      amp_dtype=get_amp_dtype(args.inference_dtype), memmap_dir=args.feature_memmap_dir)
         if return_logit:
             return total_features, total_labels, total_logits
         else:
@@ -550,7 +599,10 @@ class ModelManager:
                  'feedback_cache', 'num_cached_feedback',
                  'flag_demo', 'known_demo_num_per_class', 'flag_filtering', 'flag_demo_c', 'known_demo_num_per_class_c', 'flag_filtering_c', 'filter_threshold', 'filter_threshold_c']
         vars_dict = {k:v for k,v in zip(names, var)}
-        results = dict(self.test_results,**vars_dict)
+        # LLM telemetry of the calls since the previous saved evaluation, i.e. of the current training round
+        llm_summary = get_llm_telemetry(args).round_summary()
+        print('LLM Telemetry:', llm_summary)
+        results = dict(self.test_results, **llm_summary, **vars_dict)
         keys = list(results.keys())
         values = list(results.values())
         
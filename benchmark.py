@@ -0,0 +1,130 @@
+"""
+Benchmark the forward / backward passes of one training step (anchor, neighbor and augmented anchor views and the labeled batch):
+peak activation memory and tokens per second of each mode in args.benchmark_modes.
+legacy: backbone with the MLM head, returning all hidden states and attentions | lean: encoder only, last hidden state only
+fused: lean, with the four batches of a step concatenated into one forward
+Batches are padded and bucketed as in training, run with and without --dynamic_padding / --length_bucketing to compare.
+
+python benchmark.py --dataset clinc --known_cls_ratio 0.25 --labeled_ratio 0.1 --train_batch_size 48
+python benchmark.py --dataset clinc --known_cls_ratio 0.25 --labeled_ratio 0.1 --train_batch_size 48 --dynamic_padding --length_bucketing
+"""
+import time
+from init_parameter import init_model
+from dataloader import Data
+from model import CLBert, forward_views
+from utils.batching import LengthBucketSampler, dynamic_padding_collate
+from utils.tools import *
+from transformers import logging
+logging.set_verbosity_error()
+
+
+class LegacyCLBert(CLBert):
+    """CLBert forward of the original implementation, kept as the benchmark baseline"""
+    def __init__(self, args, model_name, device, num_labels):
+        super(LegacyCLBert, self).__init__(args, model_name, device, num_labels)
+        self.backbone = AutoModelForMaskedLM.from_pretrained(model_name).to(device)
+
+    def forward(self, X, output_hidden_states=False, output_attentions=False, output_logits=False):
+        outputs = self.backbone(**X, output_hidden_states=True, output_attentions=True)
+        cls_embed = outputs.hidden_states[-1][:,0]
+        features = F.normalize(self.head(cls_embed), dim=1)
+        if self.args.architecture in 'Loop':
+            logits = self.classifier(self.head(cls_embed))
+        else:
+            logits = self.classifier(nn.functional.normalize(cls_embed, dim=-1, p=2))
+        return {"features": features, "logits": logits}
+
+
+def get_model(args, mode, device, num_labels):
+    if mode == 'legacy':
+        return LegacyCLBert(args, args.bert_model, device, num_labels)
+    elif mode in ['lean', 'fused']:
+        return CLBert(args, args.bert_model, device=device, num_labels=num_labels)
+    raise NotImplementedError(f"Benchmark mode {mode} not implemented!")
+
+
+def to_inputs(batch, device):
+    input_ids, input_mask, segment_ids, _ = tuple(t.to(device) for t in batch)
+    return {"input_ids": input_ids, "attention_mask": input_mask, "token_type_ids": segment_ids}
+
+
+def get_train_loader(args, data):
+    """shuffled loader over the training set, dynamically padded and length bucketed like the neighbor dataloader"""
+    collate_fn = dynamic_padding_collate if args.dynamic_padding else None
+    if args.length_bucketing:
+        batch_sampler = LengthBucketSampler(data.semi_input_mask.sum(dim=1).numpy(), args.train_batch_size, shuffle=True,
+                                            bucket_size_multiplier=args.bucket_size_multiplier)
+        return DataLoader(data.train_semi_dataset, batch_sampler=batch_sampler, collate_fn=collate_fn)
+    return DataLoader(data.train_semi_dataset, batch_size=args.train_batch_size, shuffle=True, collate_fn=collate_fn)
+
+
+def step_batches(args, data, device):
+    """three training batches standing in for the anchor, neighbor and augmented anchor views, plus a labeled batch"""
+    labeled_batches = iter(data.train_labeled_dataloader) if data.train_labeled_dataloader is not None else None
+    batches = []
+    for batch in get_train_loader(args, data):
+        batches.append(to_inputs(batch, device))
+        if len(batches) == 3:
+            if labeled_batches is not None:
+                try:
+                    labeled = next(labeled_batches)
+                except StopIteration:
+                    labeled_batches = iter(data.train_labeled_dataloader)
+                    labeled = next(labeled_batches)
+                batches.append(to_inputs(labeled, device))
+            yield batches
+            batches = []
+
+
+def run_mode(args, data, mode, device):
+    if len(data.train_semi_dataloader) < 3:
+        raise ValueError('benchmark.py needs at least 3 training batches per step, use a smaller --train_batch_size')
+    model = get_model(args, mode, device, data.num_labels)
+    model.train()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.0)
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+    base_memory = torch.cuda.memory_allocated(device) if device.type == 'cuda' else 0
+
+    steps, padded_tokens, real_tokens, elapsed = 0, 0, 0, 0.0
+    while steps < args.benchmark_steps + 1:
+        for views in step_batches(args, data, device):
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            start = time.time()
+            outputs = forward_views(model, views, fused=mode == 'fused')
+            loss = sum(out["features"].sum() + out["logits"].sum() for out in outputs)
+            loss.backward()
+            optimizer.zero_grad()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            # the first step is a warm-up
+            if steps > 0:
+                elapsed += time.time() - start
+                padded_tokens += sum(X["input_ids"].numel() for X in views)
+                real_tokens += sum(int(X["attention_mask"].sum()) for X in views)
+            steps += 1
+            if steps == args.benchmark_steps + 1:
+                break
+
+    peak = (torch.cuda.max_memory_allocated(device) - base_memory) / 2**20 if device.type == 'cuda' else float('nan')
+    result = {'mode': mode, 'dynamic_padding': args.dynamic_padding, 'length_bucketing': args.length_bucketing, 'steps': steps - 1, 'step_time_ms': round(1000 * elapsed / (steps - 1), 2),
+              'tokens_per_s': round(padded_tokens / elapsed, 1), 'real_tokens_per_s': round(real_tokens / elapsed, 1),
+              'peak_activation_mb': round(peak, 1)}
+    del model, optimizer
+    return result
+
+
+if __name__ == '__main__':
+    parser = init_model()
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    data = Data(args)
+
+    results = []
+    for mode in args.benchmark_modes.split(','):
+        set_seed(args.seed)
+        results.append(run_mode(args, data, mode.strip(), device))
+        print(results[-1])
+    print(pd.DataFrame(results).to_string(index=False))
@@ -1,4 +1,7 @@
 from utils.tools import *
+from utils.batching import LengthBucketSampler, dynamic_padding_collate
+import time
+import hashlib
 
 max_seq_lengths = {'clinc':30, 'stackoverflow':45, 'banking':55}
 TOPK = {'clinc':50, 'stackoverflow':500, 'banking':50}
@@ -19,6 +22,9 @@ class Data:
         processor = DatasetProcessor()
         args.cluster_num_factor = 1
         self.data_dir = os.path.join(args.data_dir, args.dataset)
+        # one tokenizer shared by the featurization, the view generation and the managers
+        self.tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        self.tokenized_texts = TokenizedTexts(args, processor, self.data_dir, self.tokenizer)
         self.all_label_list = processor.get_labels(self.data_dir)
         self.n_known_cls = round(len(self.all_label_list) * args.known_cls_ratio)
         if self.n_known_cls > 0:
@@ -48,6 +54,8 @@ class Data:
 
         self.semi_input_ids, self.semi_input_mask, self.semi_segment_ids, self.semi_label_ids = self.get_semi(self.train_labeled_examples, self.train_unlabeled_examples, args)
         self.train_semi_dataset, self.train_semi_dataloader = self.get_semi_loader(self.semi_input_ids, self.semi_input_mask, self.semi_segment_ids, self.semi_label_ids, args)
+        # special tokens of the training set, precomputed once for the view generation
+        self.semi_special_tokens_mask = get_special_tokens_mask(self.semi_input_ids, self.tokenizer)
 
         self.eval_dataloader = self.get_loader(self.eval_examples, args, 'eval')
         self.test_dataloader = self.get_loader(self.test_examples, args, 'test')
@@ -101,25 +109,27 @@ class Data:
                 train_labeled_examples = []
                 train_unlabeled_examples = copy.deepcopy(ori_examples)
             else:
+                # indices of every label in ascending order, grouped with one stable sort
+                order = np.argsort(train_labels, kind='stable')
+                group_labels, group_starts, group_counts = np.unique(train_labels[order], return_index=True, return_counts=True)
+                label_inds = {label: order[start:start + count] for label, start, count in zip(group_labels, group_starts, group_counts)}
                 for label in self.known_label_list:
+                    pos = list(label_inds.get(label, np.array([], dtype=np.int64)))
                     if args.label_setting == 'shot':
                         num = args.labeled_shot
                     elif args.label_setting == 'ratio':
-                        num = round(len(train_labels[train_labels == label]) * args.labeled_ratio)
+                        num = round(len(pos) * args.labeled_ratio)
                     else:
                         raise NotImplementedError(f"Label setting {args.label_setting} not chosen from ['shot', 'ratio']")
-                    pos = list(np.where(train_labels == label)[0]) 
                     # handle the case when the number of labeled samples is larger than the number of samples in the class
                     if num > len(pos):
                         num = len(pos)               
                     train_labeled_ids.extend(random.sample(pos, num))
 
-                train_labeled_examples, train_unlabeled_examples = [], []
-                for idx, example in enumerate(ori_examples):
-                    if idx in train_labeled_ids:
-                        train_labeled_examples.append(example)
-                    else:
-                        train_unlabeled_examples.append(example)
+                labeled_mask = np.zeros(len(ori_examples), dtype=bool)
+                labeled_mask[np.array(train_labeled_ids, dtype=np.int64)] = True
+                train_labeled_examples = [example for example, labeled in zip(ori_examples, labeled_mask) if labeled]
+                train_unlabeled_examples = [example for example, labeled in zip(ori_examples, labeled_mask) if not labeled]
 
             return train_labeled_examples, train_unlabeled_examples
 
@@ -137,21 +147,12 @@ class Data:
             raise NotImplementedError(f"Mode {mode} not found")
 
     def get_semi(self, labeled_examples, unlabeled_examples, args):
-        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
         if self.n_known_cls > 0:
-            labeled_features = convert_examples_to_features(args, labeled_examples, self.known_label_list, args.max_seq_length, tokenizer)
-            labeled_input_ids = torch.tensor([f.input_ids for f in labeled_features], dtype=torch.long)
-            labeled_input_mask = torch.tensor([f.input_mask for f in labeled_features], dtype=torch.long)
-            labeled_segment_ids = torch.tensor([f.segment_ids for f in labeled_features], dtype=torch.long)
-            labeled_label_ids = torch.tensor([f.label_id for f in labeled_features], dtype=torch.long)  
-        else:
-            labeled_features = None
+            labeled_input_ids, labeled_input_mask, labeled_segment_ids, labeled_label_ids = \
+                convert_examples_to_features(args, labeled_examples, self.known_label_list, self.tokenized_texts)
 
-        unlabeled_features = convert_examples_to_features(args, unlabeled_examples, self.all_label_list, args.max_seq_length, tokenizer, mode='semi')
-        unlabeled_input_ids = torch.tensor([f.input_ids for f in unlabeled_features], dtype=torch.long)
-        unlabeled_input_mask = torch.tensor([f.input_mask for f in unlabeled_features], dtype=torch.long)
-        unlabeled_segment_ids = torch.tensor([f.segment_ids for f in unlabeled_features], dtype=torch.long)
-        unlabeled_label_ids = torch.tensor([f.label_id for f in unlabeled_features], dtype=torch.long)     
+        unlabeled_input_ids, unlabeled_input_mask, unlabeled_segment_ids, unlabeled_label_ids = \
+            convert_examples_to_features(args, unlabeled_examples, self.all_label_list, self.tokenized_texts, mode='semi')
 
         if self.n_known_cls > 0:
             semi_input_ids = torch.cat([labeled_input_ids, unlabeled_input_ids])
@@ -167,38 +168,47 @@ class Data:
 
     def get_semi_loader(self, semi_input_ids, semi_input_mask, semi_segment_ids, semi_label_ids, args):
         semi_data = TensorDataset(semi_input_ids, semi_input_mask, semi_segment_ids, semi_label_ids)
-        semi_sampler = SequentialSampler(semi_data)
-        semi_dataloader = DataLoader(semi_data, sampler=semi_sampler, batch_size = args.train_batch_size) 
+        if args.length_bucketing:
+            semi_dataloader = self.get_bucketed_loader(semi_data, args.train_batch_size, args)
+        else:
+            semi_sampler = SequentialSampler(semi_data)
+            semi_dataloader = DataLoader(semi_data, sampler=semi_sampler, batch_size = args.train_batch_size, collate_fn=self.get_collate_fn(args))
 
         return semi_data, semi_dataloader
 
     def get_loader(self, examples, args, mode = 'train'):
-        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
-        
         if mode == 'train' or mode == 'eval':
-            features = convert_examples_to_features(args, examples, self.known_label_list, args.max_seq_length, tokenizer, mode)
+            input_ids, input_mask, segment_ids, label_ids = convert_examples_to_features(args, examples, self.known_label_list, self.tokenized_texts, mode)
         elif mode == 'test':
-            features = convert_examples_to_features(args, examples, self.all_label_list, args.max_seq_length, tokenizer, mode)
+            input_ids, input_mask, segment_ids, label_ids = convert_examples_to_features(args, examples, self.all_label_list, self.tokenized_texts, mode)
         else:
             raise NotImplementedError(f"Mode {mode} not found")
 
-        input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-        input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-        segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-        label_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
         data = TensorDataset(input_ids, input_mask, segment_ids, label_ids)
         
         if mode == 'train':
             sampler = RandomSampler(data)
-            dataloader = DataLoader(data, sampler=sampler, batch_size = args.pretrain_batch_size)    
+            dataloader = DataLoader(data, sampler=sampler, batch_size = args.pretrain_batch_size, collate_fn=self.get_collate_fn(args))
+        elif mode in ["eval", "test"] and args.length_bucketing:
+            dataloader = self.get_bucketed_loader(data, args.eval_batch_size, args)
         elif mode in ["eval", "test"]:
             sampler = SequentialSampler(data)
-            dataloader = DataLoader(data, sampler=sampler, batch_size = args.eval_batch_size)
+            dataloader = DataLoader(data, sampler=sampler, batch_size = args.eval_batch_size, collate_fn=self.get_collate_fn(args))
         else:
             raise NotImplementedError(f"Mode {mode} not found")
         
         return dataloader
 
+    def get_collate_fn(self, args):
+        # None falls back to the default collate of fixed-length batches
+        return dynamic_padding_collate if args.dynamic_padding else None
+
+    def get_bucketed_loader(self, data, batch_size, args):
+        """sequential loader whose batches group sequences of similar length, in the same order every epoch"""
+        lengths = data.tensors[1].sum(dim=1).numpy()
+        batch_sampler = LengthBucketSampler(lengths, batch_size, shuffle=False, bucket_size_multiplier=args.bucket_size_multiplier)
+        return DataLoader(data, batch_sampler=batch_sampler, collate_fn=self.get_collate_fn(args))
+
 
 class InputExample(object):
     """A single training/test example for simple sequence classification."""
@@ -297,7 +307,67 @@ class DatasetProcessor(DataProcessor):
         return examples
 
 
-def convert_examples_to_features(args, examples, label_list, max_seq_length, tokenizer, mode=None):      
+class TokenizedTexts(object):
+    """
+    Token ids of every text in the train / dev / test files of a dataset, tokenized with one batched fast tokenizer call
+    and cached on disk as .npz keyed by (dataset, tokenizer, max_seq_length, hash of the data files),
+    so repeated runs of a sweep skip tokenization. Examples are mapped to their rows by text.
+    """
+    def __init__(self, args, processor, data_dir, tokenizer):
+        self.max_seq_length = args.max_seq_length
+        start = time.time()
+        texts = sorted(set(example.text_a for mode in ['train', 'eval', 'test'] for example in processor.get_examples(data_dir, mode)))
+
+        cache_path = None
+        if not args.disable_feature_cache and args.feature_cache_dir:
+            cache_path = os.path.join(args.feature_cache_dir, self.cache_name(args, data_dir, tokenizer))
+        if cache_path is not None and os.path.exists(cache_path):
+            with np.load(cache_path) as cached:
+                self.texts = cached['texts']
+                self.input_ids, self.attention_mask, self.token_type_ids = cached['input_ids'], cached['attention_mask'], cached['token_type_ids']
+            source = f'loaded from {cache_path}'
+        else:
+            self.texts = np.array(texts)
+            self.input_ids, self.attention_mask, self.token_type_ids = self.tokenize(texts, tokenizer)
+            source = 'tokenized'
+            if cache_path is not None:
+                os.makedirs(args.feature_cache_dir, exist_ok=True)
+                tmp_path = cache_path + f'.{os.getpid()}.tmp.npz'
+                np.savez(tmp_path, texts=self.texts, input_ids=self.input_ids, attention_mask=self.attention_mask, token_type_ids=self.token_type_ids)
+                os.replace(tmp_path, cache_path)
+                source += f', cached to {cache_path}'
+        self.rows = {text: i for i, text in enumerate(self.texts.tolist())}
+        print(f'{len(self.rows)} texts {source} in {time.time() - start:.2f}s')
+
+    @staticmethod
+    def cache_name(args, data_dir, tokenizer):
+        file_hash = hashlib.sha256()
+        for file_name in ['train.tsv', 'dev.tsv', 'test.tsv']:
+            path = os.path.join(data_dir, file_name)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    file_hash.update(f.read())
+        tokenizer_key = f'{tokenizer.name_or_path}\x00{type(tokenizer).__name__}\x00{len(tokenizer)}'
+        tokenizer_hash = hashlib.sha256(tokenizer_key.encode('utf-8')).hexdigest()[:8]
+        tokenizer_name = os.path.basename(os.path.normpath(str(tokenizer.name_or_path))).replace(os.sep, '_')
+        return f'{args.dataset}_{tokenizer_name}-{tokenizer_hash}_{args.max_seq_length}_{file_hash.hexdigest()[:16]}.npz'
+
+    def tokenize(self, texts, tokenizer):
+        tokens = tokenizer(texts, padding='max_length', max_length=self.max_seq_length, truncation=True, return_tensors='np')
+        input_ids = tokens['input_ids'].astype(np.int64)
+        attention_mask = tokens['attention_mask'].astype(np.int64)
+        token_type_ids = tokens['token_type_ids'].astype(np.int64) if 'token_type_ids' in tokens else np.zeros_like(input_ids)
+        assert input_ids.shape[1] == self.max_seq_length
+        return input_ids, attention_mask, token_type_ids
+
+    def lookup(self, examples):
+        """(input_ids, attention_mask, token_type_ids) tensors of the examples"""
+        rows = np.array([self.rows[example.text_a] for example in examples], dtype=np.int64)
+        return torch.from_numpy(self.input_ids[rows]), torch.from_numpy(self.attention_mask[rows]), torch.from_numpy(self.token_type_ids[rows])
+
+
+def convert_examples_to_features(args, examples, label_list, tokenized_texts, mode=None):
+    """(input_ids, input_mask, segment_ids, label_ids) tensors of the examples"""
     label_map = {}
     for i, label in enumerate(label_list):
         label_map[label] = i
@@ -314,23 +384,6 @@ def convert_examples_to_features(args, examples, label_list, max_seq_length, tok
         args.label_map_semi = label_map
         args.get_label_name_semi = {v: k for k, v in label_map.items()}
 
-    features = []
-    for (index, example) in enumerate(examples):
-        tokens = tokenizer(example.text_a, padding='max_length', max_length=max_seq_length, truncation=True)
-
-        input_ids = tokens['input_ids']
-        input_mask = tokens['attention_mask']
-        segment_ids = tokens['token_type_ids']
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        label_id = label_map[example.label]
-        features.append(
-            InputFeatures(input_ids=input_ids,
-                            input_mask=input_mask,
-                            segment_ids=segment_ids,
-                            label_id=label_id))
-    return features
-
-
+    input_ids, input_mask, segment_ids = tokenized_texts.lookup(examples)
+    label_ids = torch.tensor([label_map[example.label] for example in examples], dtype=torch.long)
+    return input_ids, input_mask, segment_ids, label_ids
@@ -83,8 +83,69 @@ def init_model():
     parser.add_argument("--topk", default=50, type=int,
                         help="Select topk nearest neighbors")
 
+    parser.add_argument("--inference_dtype", default="fp32", type=str, help="Autocast precision for feature extraction, choose from fp32|bf16|fp16")
+
+    parser.add_argument("--feature_memmap_dir", default=None, type=str,
+                        help="Stream extracted features to memory-mapped .npy files in this directory instead of device memory.")
+
+    parser.add_argument("--feature_cache_dir", default='./cache/features', type=str,
+                        help="Directory of the tokenized dataset cache shared across runs.")
+
+    parser.add_argument("--disable_feature_cache", action="store_true", help="Tokenize the dataset without reading or writing the cache.")
+
+    parser.add_argument("--attn_implementation", default=None, type=str,
+                        help="Attention implementation of the backbone, e.g. sdpa|flash_attention_2, used only when the installed transformers supports it for the backbone.")
+
+    parser.add_argument("--fused_forward", action="store_true",
+                        help="Run the anchor, neighbor, augmented anchor and labeled batches through one concatenated forward per training step.")
+
+    parser.add_argument("--dynamic_padding", action="store_true", help="Trim every batch to its longest sequence instead of max_seq_length.")
+
+    parser.add_argument("--length_bucketing", action="store_true",
+                        help="Batch sequences of similar length in the training set, eval / test and neighbor dataloaders, use with --dynamic_padding.")
+
+    parser.add_argument("--bucket_size_multiplier", default=50, type=int,
+                        help="Shuffled length bucketing sorts pools of train_batch_size * bucket_size_multiplier samples by length.")
+
+    parser.add_argument("--num_workers", default=0, type=int, help="# DataLoader worker processes of the neighbor dataset, 0 loads in the main process.")
+    parser.add_argument("--pin_memory", action="store_true", help="Pin the neighbor batches in page-locked memory for asynchronous host to device copies.")
+    parser.add_argument("--persistent_workers", action="store_true", help="Keep the DataLoader workers alive across the epochs of a round.")
+    parser.add_argument("--prefetch_factor", default=2, type=int, help="# Batches prefetched by each DataLoader worker.")
+    parser.add_argument("--amp_dtype", default="fp32", type=str,
+                        help="Autocast precision for training and pre-training, choose from fp32|bf16|fp16 (fp16 uses dynamic loss scaling).")
+
+    parser.add_argument("--grad_accum_steps", default=1, type=int, help="# Batches whose gradients are accumulated per optimizer step.")
+
+    parser.add_argument("--bf16_weights", action="store_true", help="Store the model weights in bf16 during training and pre-training.")
+
+    parser.add_argument("--fp32_master_weights", action="store_true",
+                        help="With --bf16_weights, let the optimizer update fp32 master copies of the weights.")
+
+    parser.add_argument("--neg_queue_size", default=0, type=int,
+                        help="# Anchor features of previous steps used as extra contrast samples in the contrastive loss, 0 to disable.")
+
+    parser.add_argument("--benchmark_steps", default=20, type=int, help="# Timed training steps per mode in benchmark.py.")
+
+    parser.add_argument("--benchmark_modes", default="legacy,lean,fused", type=str,
+                        help="Comma separated forward modes compared by benchmark.py, choose from legacy|lean|fused.")
+
     parser.add_argument("--grad_clip", default=1, type=float,
                         help="Value for gradient clipping.")
+
+    # Clustering
+    parser.add_argument("--kmeans_backend", default="sklearn", type=str, help="Choose from sklearn|minibatch|torch")
+    parser.add_argument("--kmeans_warm_start", action="store_true", help="Warm-start k-means from the previous training round.")
+    parser.add_argument("--kmeans_max_iter", default=300, type=int, help="Max # iterations of the minibatch and torch k-means.")
+    parser.add_argument("--kmeans_batch_size", default=1024, type=int, help="Batch size of the minibatch k-means.")
+
+    # kNN Index
+    parser.add_argument("--knn_backend", default="auto", type=str, help="Choose from auto|flat|ivf|hnsw|torch, auto uses exact faiss search if installed and torch otherwise")
+    parser.add_argument("--knn_device", default="auto", type=str, help="Choose from auto|cpu|gpu")
+    parser.add_argument("--knn_nlist", default=0, type=int, help="# Inverted lists of the ivf index, 0 for 4*sqrt(N).")
+    parser.add_argument("--knn_nprobe", default=8, type=int, help="# Inverted lists visited per query by the ivf index.")
+    parser.add_argument("--knn_hnsw_m", default=32, type=int, help="# Links per node of the hnsw index.")
+    parser.add_argument("--knn_ef_search", default=128, type=int, help="efSearch of the hnsw index.")
+    parser.add_argument("--knn_report_recall", action="store_true", help="Report recall of the kNN index against the exact search.")
     
     # DistillLoss
     parser.add_argument('--memax_weight', type=float, default=1)
@@ -132,13 +193,33 @@ def init_model():
     # Self-Adaptive Querying
     parser.add_argument("--sampling_strategy", default="highest", type=str, help="Choose from random|highest|equal_highest|adaptive_difficulty")
     parser.add_argument("--allocation_degree", default=1, type=float, help="degree of convexity or concavity for the allocation function")
+    parser.add_argument("--soft_assign_chunk_size", default=4096, type=int, help="# Samples per chunk when computing the soft cluster assignment for query sampling.")
 
     # Cluster Instance Alignment Learning
     parser.add_argument("--weight_cluster_instance_cl", default=0, type=float, help="The weight of alignment loss.")    
     parser.add_argument("--options_cluster_instance_ratio", default=0.5, type=float, help="# Options in querying llm.")
+    parser.add_argument("--cluster_des_encode", default="step", type=str, help="When to re-encode cluster descriptions, choose from step|every_k|round")
+    parser.add_argument("--cluster_des_encode_every", default=10, type=int, help="Re-encode cluster descriptions every k steps in every_k mode.")
 
     # LLM Feedback Caching & Replaying
     parser.add_argument("--feedback_cache", action="store_true", help="Save all feedback.")
+    parser.add_argument("--llm_cache_path", default='./cache/llm_responses.db', type=str, help="Path of the persistent LLM response cache shared across runs.")
+    parser.add_argument("--llm_cache_max_entries", default=200000, type=int, help="Max # cached LLM responses, least recently used ones are evicted.")
+    parser.add_argument("--disable_llm_cache", action="store_true", help="Disable the persistent LLM response cache.")
+    parser.add_argument("--llm_concurrency", default=8, type=int, help="Max # concurrent LLM requests when resolving feedback for query samples.")
+    parser.add_argument("--llm_batch_queries", default=1, type=int, help="# Query samples packed into one neighbor selection request, 1 disables batched prompts.")
+    parser.add_argument("--llm_base_url", default=None, type=str, help="Base URL of the LLM API, e.g. a local OpenAI compatible server. Defaults to the provider's endpoint.")
+    parser.add_argument("--llm_rpm", default=0, type=int, help="Max # LLM requests per minute, 0 disables the limit.")
+    parser.add_argument("--llm_tpm", default=0, type=int, help="Max # (estimated) LLM tokens per minute, 0 disables the limit.")
+    parser.add_argument("--llm_max_retries", default=4, type=int, help="# Retries of a failed LLM request.")
+    parser.add_argument("--llm_backoff_base", default=1.0, type=float, help="Base delay (seconds) of the exponential backoff between LLM retries.")
+    parser.add_argument("--llm_max_backoff", default=60.0, type=float, help="Max delay (seconds) between LLM retries, also caps Retry-After.")
+    parser.add_argument("--llm_breaker_threshold", default=10, type=int, help="# Consecutive failed LLM calls that open the circuit breaker, 0 disables it.")
+    parser.add_argument("--llm_breaker_cooldown", default=60.0, type=float, help="Seconds the circuit breaker rejects LLM calls once open.")
+    parser.add_argument("--llm_trace_path", default=None, type=str, help="JSONL trace of all LLM calls and per-round summaries, no trace is written if not given.")
+    parser.add_argument("--llm_prompt_price", default=0.0, type=float, help="USD per 1M prompt tokens, used for the llm_cost column.")
+    parser.add_argument("--llm_completion_price", default=0.0, type=float, help="USD per 1M completion tokens, used for the llm_cost column.")
+    parser.add_argument("--characterization_workers", default=1, type=int, help="# Worker processes fitting the per-cluster sub-KMeans of nearest_sub_kmeans_centriods, 1 fits them in process.")
 
     # LLM Feedback Enhancement and Filtering for Instance-Level Feedback
     parser.add_argument("--flag_demo", action="store_true", help="Enable demo in prompt.")      # default: False
@@ -1,13 +1,63 @@
 from utils.tools import *
 from utils.contrastive import SupConLoss
-        
+from torch.nn.utils.rnn import pad_sequence
+from transformers import AutoConfig
+
+
+def supports_attn_implementation(auto_model, model_name, attn_implementation):
+    """whether the installed transformers implements attn_implementation for the model class of model_name, checked on the config only"""
+    try:
+        model_class = auto_model._model_mapping[type(AutoConfig.from_pretrained(model_name))]
+    except KeyError:
+        return False
+    # transformers releases before attn_implementation (e.g. the pinned 4.15) have none of these flags
+    if attn_implementation == 'eager':
+        return hasattr(model_class, '_supports_sdpa')
+    flag = {'sdpa': '_supports_sdpa', 'flash_attention_2': '_supports_flash_attn_2'}.get(attn_implementation)
+    return flag is not None and bool(getattr(model_class, flag, False))
+
+
+def load_backbone(model_name, masked_lm=False, attn_implementation=None):
+    """
+    load the transformer backbone: the encoder only (without pooler) unless the MLM head is needed for pre-training,
+    using the requested attention implementation (e.g. sdpa) when the installed transformers supports it for this model
+    """
+    auto_model = AutoModelForMaskedLM if masked_lm else AutoModel
+    if attn_implementation and supports_attn_implementation(auto_model, model_name, attn_implementation):
+        backbone = auto_model.from_pretrained(model_name, attn_implementation=attn_implementation)
+    else:
+        if attn_implementation:
+            print(f'Attention implementation {attn_implementation} is not supported for {model_name} by the installed transformers, using the default attention')
+        backbone = auto_model.from_pretrained(model_name)
+    if not masked_lm and getattr(backbone, 'pooler', None) is not None:
+        # only the CLS token of the last hidden state is used
+        backbone.pooler = None
+    return backbone
+
+
+def forward_views(model, views, fused=False):
+    """
+    run the model on a list of input dicts and return one output dict per view.
+    fused: a single forward over the views concatenated along the batch (padded to a common length) and split back,
+    dropout masks are drawn independently for every row so each view still gets its own masks as with separate calls
+    """
+    if not fused:
+        return [model(X) for X in views]
+    max_len = max(X["input_ids"].size(1) for X in views)
+    X_all = {k: torch.cat([F.pad(X[k], (0, max_len - X[k].size(1))) for X in views]) for k in views[0]}
+    outputs = model(X_all)
+    sizes = [X["input_ids"].size(0) for X in views]
+    splits = {k: torch.split(v, sizes) for k, v in outputs.items()}
+    return [{k: splits[k][i] for k in splits} for i in range(len(views))]
+
+
 class BertForModel(nn.Module):
-    def __init__(self,model_name, num_labels, device=None):
+    def __init__(self,model_name, num_labels, device=None, attn_implementation=None):
         super(BertForModel, self).__init__()
         self.num_labels = num_labels
         self.model_name = model_name
         self.device = device
-        self.backbone = AutoModelForMaskedLM.from_pretrained(self.model_name)
+        self.backbone = load_backbone(self.model_name, masked_lm=True, attn_implementation=attn_implementation)
         self.classifier = nn.Linear(768, self.num_labels)
         self.dropout = nn.Dropout(0.1)
         self.backbone.to(self.device)
@@ -15,15 +65,16 @@ class BertForModel(nn.Module):
 
     def forward(self, X, output_hidden_states=False, output_attentions=False):
         """logits are not normalized by softmax in forward function"""
-        outputs = self.backbone(**X, output_hidden_states=True)
-        CLSEmbedding = outputs.hidden_states[-1][:,0]
-        CLSEmbedding = self.dropout(CLSEmbedding)
+        # the encoder alone, the MLM head is only needed in mlmForward
+        outputs = self.backbone.base_model(**X, output_attentions=output_attentions)
+        cls_embed = outputs.last_hidden_state[:, 0]
+        CLSEmbedding = self.dropout(cls_embed)
         logits = self.classifier(CLSEmbedding)
         output_dir = {"logits": logits}
         if output_hidden_states:
-            output_dir["hidden_states"] = outputs.hidden_states[-1][:, 0]
+            output_dir["hidden_states"] = cls_embed
         if output_attentions:
-            output_dir["attentions"] = outputs.attention
+            output_dir["attentions"] = outputs.attentions
         return output_dir
 
     def mlmForward(self, X, Y):
@@ -46,7 +97,7 @@ class CLBert(nn.Module):
         self.model_name = model_name
         self.device = device
         self.num_labels = num_labels
-        self.backbone = AutoModelForMaskedLM.from_pretrained(self.model_name)
+        self.backbone = load_backbone(self.model_name, attn_implementation=args.attn_implementation)
         hidden_size = self.backbone.config.hidden_size
         self.head = nn.Sequential(
             nn.Linear(hidden_size, hidden_size),
@@ -71,8 +122,8 @@ class CLBert(nn.Module):
         
     def forward(self, X, output_hidden_states=False, output_attentions=False, output_logits=False):
         """logits are not normalized by softmax in forward function"""
-        outputs = self.backbone(**X, output_hidden_states=True, output_attentions=True)
-        cls_embed = outputs.hidden_states[-1][:,0]
+        outputs = self.backbone(**X, output_attentions=output_attentions)
+        cls_embed = outputs.last_hidden_state[:, 0]
         features = F.normalize(self.head(cls_embed), dim=1)
         output_dir = {"features": features}
         
@@ -89,10 +140,10 @@ class CLBert(nn.Module):
             output_dir["attentions"] = outputs.attentions
         return output_dir
 
-    def loss_cl(self, embds, label=None, mask=None, temperature=0.07, base_temperature=0.07):
-        """compute contrastive loss"""
+    def loss_cl(self, embds, label=None, mask=None, temperature=0.07, base_temperature=0.07, queue=None, queue_mask=None):
+        """compute contrastive loss, optionally with the features of previous steps as extra contrast samples"""
         loss = SupConLoss(temperature=temperature, base_temperature=base_temperature)
-        output = loss(embds, labels=label, mask=mask)
+        output = loss(embds, labels=label, mask=mask, queue=queue, queue_mask=queue_mask)
         return output
     
     def loss_ce(self, logits, Y):
@@ -100,6 +151,24 @@ class CLBert(nn.Module):
         output = loss(logits, Y)
         return output
 
+    def loss_cluster_instance(self, embds, cluster_embds, pos_cluster_idx, neg_cluster_idx, temperature=0.07):
+        """
+        compute cluster description and instance alignment loss -log(exp(sim_pos) / sum(exp(sim_neg))) for all instances at once,
+        the variable-size negative cluster sets are padded and masked out of the sum
+        """
+        device = embds.device
+        pos_cluster_idx = torch.tensor([int(i) for i in pos_cluster_idx], dtype=torch.long, device=device)
+        neg_cluster_idx = [torch.as_tensor(i, dtype=torch.long).view(-1) for i in neg_cluster_idx]
+        neg_mask = pad_sequence([torch.ones(len(i), dtype=torch.bool) for i in neg_cluster_idx], batch_first=True).to(device)
+        neg_cluster_idx = pad_sequence(neg_cluster_idx, batch_first=True).to(device)
+
+        # cosine similarity between every instance and every cluster description
+        sim = torch.matmul(F.normalize(embds, dim=1), F.normalize(cluster_embds, dim=1).t()) / temperature
+        sim_positive = sim.gather(1, pos_cluster_idx.unsqueeze(1)).squeeze(1)
+        sim_negatives = sim.gather(1, neg_cluster_idx).masked_fill(~neg_mask, float('-inf'))
+        loss = torch.logsumexp(sim_negatives, dim=1) - sim_positive
+        return loss.mean()
+
     def save_backbone(self, save_path):
         self.backbone.save_pretrained(save_path)
 
@@ -1,5 +1,7 @@
+import math
 from utils.tools import *
 from model import BertForModel
+from utils.amp import get_training_step, cast_weights
 from transformers import WEIGHTS_NAME, CONFIG_NAME, AutoTokenizer
 
 class PretrainModelManager:
@@ -12,13 +14,16 @@ class PretrainModelManager:
         n_gpu = torch.cuda.device_count()
         print(n_gpu)
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model = BertForModel(args.bert_model, num_labels=data.n_known_cls, device=self.device)
+        self.model = BertForModel(args.bert_model, num_labels=data.n_known_cls, device=self.device, attn_implementation=args.attn_implementation)
         if n_gpu > 1:
             self.model = nn.DataParallel(self.model)
+        # fp32 master weights are taken before the cast, so they keep the unrounded (pre)trained weights
+        self.master_weights = cast_weights(self.model, torch.bfloat16, keep_fp32=args.fp32_master_weights) if args.bf16_weights else None
         
-        self.num_train_optimization_steps = int(len(data.train_labeled_examples) / args.pretrain_batch_size) * args.num_pretrain_epochs
+        self.num_train_optimization_steps = math.ceil(int(len(data.train_labeled_examples) / args.pretrain_batch_size) / args.grad_accum_steps) * args.num_pretrain_epochs
 
         self.optimizer, self.scheduler = self.get_optimizer(args)
+        self.training_step = get_training_step(args, self.optimizer, self.scheduler, self.device, 1.0, master_weights=self.master_weights)
         
         self.best_eval_score = 0
         
@@ -26,19 +31,8 @@ class PretrainModelManager:
         """
         calculate acc on validation set
         """
-        self.model.eval()
-
-        total_labels = torch.empty(0,dtype=torch.long).to(self.device)
-        total_logits = torch.empty((0, data.n_known_cls)).to(self.device)
-        
-        for batch in tqdm(data.eval_dataloader, desc="Iteration"):
-            batch = tuple(t.to(self.device) for t in batch)
-            input_ids, input_mask, segment_ids, label_ids = batch
-            X = {"input_ids":input_ids, "attention_mask": input_mask, "token_type_ids": segment_ids}
-            with torch.set_grad_enabled(False):
-                logits = self.model(X)["logits"]
-                total_labels = torch.cat((total_labels,label_ids))
-                total_logits = torch.cat((total_logits, logits))
+        _, total_labels, total_logits = extract_features(self.model, data.eval_dataloader, self.device, num_logits=data.n_known_cls,
+                                                         amp_dtype=get_amp_dtype(args.inference_dtype))
         
         total_probs, total_preds = F.softmax(total_logits.detach(), dim=1).max(dim = 1)
         y_pred = total_preds.cpu().numpy()
@@ -48,7 +42,7 @@ class PretrainModelManager:
         return acc
         
     def train(self, args, data):
-        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        tokenizer = data.tokenizer
         wait = 0
         best_model = None
         mlm_iter = iter(data.train_semi_dataloader) # mlm on semi-dataloader
@@ -80,7 +74,7 @@ class PretrainModelManager:
                 X_mlm["input_ids"] = mask_ids.to(self.device)
 
                 # 3. compute loss and update parameters
-                with torch.set_grad_enabled(True):
+                with torch.set_grad_enabled(True), self.training_step.autocast():
                     logits = self.model(X)["logits"]
                     if isinstance(self.model, nn.DataParallel):
                         loss_src = self.model.module.loss_ce(logits, label_ids)
@@ -89,17 +83,15 @@ class PretrainModelManager:
                         loss_src = self.model.loss_ce(logits, label_ids)
                         loss_mlm = self.model.mlmForward(X_mlm, mask_lb.to(self.device))
                     lossTOT = loss_src + loss_mlm
-                    lossTOT.backward()
-                    nn.utils.clip_grad_norm_(self.model.parameters(), 1.0)
-                    tr_loss += lossTOT.item()
-                    
-                    self.optimizer.step()
-                    self.scheduler.step()
-                    self.optimizer.zero_grad()
-                    
-                    nb_tr_examples += input_ids.size(0)
-                    nb_tr_steps += 1
-            
+
+                # backward outside autocast, the optimizer steps every args.grad_accum_steps batches
+                self.training_step.backward(lossTOT)
+                tr_loss += lossTOT.item()
+
+                nb_tr_examples += input_ids.size(0)
+                nb_tr_steps += 1
+
+            self.training_step.flush()
             loss = tr_loss / nb_tr_steps
             print('train_loss',loss)
             
@@ -144,18 +136,6 @@ class PretrainModelManager:
             f.write(self.save_model.config.to_json_string())
          
     def get_features_labels(self, dataloader, model, args):
-        model.eval()
-        total_features = torch.empty((0,args.feat_dim)).to(self.device)
-        total_labels = torch.empty(0,dtype=torch.long).to(self.device)
-
-        for batch in tqdm(dataloader, desc="Extracting representation"):
-            batch = tuple(t.to(self.device) for t in batch)
-            input_ids, input_mask, segment_ids, label_ids = batch
-            X = {"input_ids":input_ids, "attention_mask": input_mask, "token_type_ids": segment_ids}
-            with torch.no_grad():
-                feature = model(X, output_hidden_states=True)["hidden_states"]
-
-            total_features = torch.cat((total_features, feature))
-            total_labels = torch.cat((total_labels, label_ids))
-
+        total_features, total_labels, _ = extract_features(model, dataloader, self.device, feat_dim=args.feat_dim,
+                                                           amp_dtype=get_amp_dtype(args.inference_dtype), memmap_dir=args.feature_memmap_dir)
         return total_features, total_labels
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+import torch
+
+from GCDLLMs import ModelManager
+
+
+def reference_adjacency(args, inds, neighbors, targets, key_inds=None, key_targets=None):
+    """the original nested loop, extended to keys other than the batch (the diagonal becomes inds[b1] == keys[b2])"""
+    keys = inds if key_inds is None else key_inds
+    key_targets = targets if key_targets is None else key_targets
+    adj = torch.zeros(inds.shape[0], keys.shape[0])
+    for b1, n in enumerate(neighbors):
+        for b2, j in enumerate(keys):
+            if key_inds is None and b1 == b2 or key_inds is not None and inds[b1] == j:
+                adj[b1][b2] = 1
+            if j in n:
+                adj[b1][b2] = 1 # if in neighbors
+            if (targets[b1] == key_targets[b2]) and (inds[b1] <= args.num_labeled_examples) and (j <= args.num_labeled_examples):
+                adj[b1][b2] = 1 # if same labels
+    return adj
+
+
+def make_batch(seed, n=200, bz=16, topk=10, n_classes=4):
+    g = torch.Generator().manual_seed(seed)
+    inds = torch.randperm(n, generator=g)[:bz]
+    neighbors = torch.stack([torch.randperm(n, generator=g)[:topk] for _ in range(bz)])
+    # make sure some batch members are neighbors of each other
+    neighbors[:, 0] = inds[torch.randint(bz, (bz,), generator=g)]
+    targets = torch.randint(n_classes, (bz,), generator=g)
+    return inds, neighbors, targets
+
+
+def get_adjacency(*args, **kwargs):
+    manager = SimpleNamespace(device=torch.device('cpu'))
+    return ModelManager.get_adjacency(manager, *args, **kwargs)
+
+
+def test_adjacency_matches_loop():
+    args = SimpleNamespace(num_labeled_examples=80)
+    for seed in range(5):
+        inds, neighbors, targets = make_batch(seed)
+        adj = get_adjacency(args, inds, neighbors, targets)
+        assert adj.shape == (len(inds), len(inds))
+        assert torch.equal(adj, reference_adjacency(args, inds, neighbors, targets))
+
+
+def test_adjacency_with_keys_matches_loop():
+    args = SimpleNamespace(num_labeled_examples=80)
+    for seed in range(5):
+        inds, neighbors, targets = make_batch(seed)
+        # queue keys: some of the batch, some neighbors and some unrelated samples
+        key_inds, _, key_targets = make_batch(seed + 100, bz=24)
+        key_inds[:4] = inds[:4]
+        key_inds[4:8] = neighbors[4:8, 1]
+        adj = get_adjacency(args, inds, neighbors, targets, key_inds=key_inds, key_targets=key_targets)
+        assert adj.shape == (len(inds), len(key_inds))
+        assert torch.equal(adj, reference_adjacency(args, inds, neighbors, targets, key_inds, key_targets))
@@ -0,0 +1,34 @@
+import torch
+import torch.nn.functional as F
+
+from model import CLBert
+
+
+def reference_loss(embds, cluster_embds, pos_cluster_idx, neg_cluster_idx, temperature):
+    """the original per-sample loop, averaged over the instances"""
+    loss = 0
+    for i in range(len(embds)):
+        sim_positive = F.cosine_similarity(embds[i].unsqueeze(0), cluster_embds[pos_cluster_idx[i]].unsqueeze(0), dim=1) / temperature
+        sim_negatives = F.cosine_similarity(embds[i].unsqueeze(0), cluster_embds[neg_cluster_idx[i]], dim=1) / temperature
+        loss = loss - torch.log(torch.exp(sim_positive) / torch.exp(sim_negatives).sum())
+    return loss.sum() / len(embds)
+
+
+def test_cluster_instance_loss_matches_loop():
+    g = torch.Generator().manual_seed(0)
+    for _ in range(10):
+        n = int(torch.randint(1, 17, (1,), generator=g))
+        n_clusters = int(torch.randint(3, 30, (1,), generator=g))
+        embds = torch.randn(n, 32, dtype=torch.float64, generator=g, requires_grad=True)
+        cluster_embds = torch.randn(n_clusters, 32, dtype=torch.float64, generator=g, requires_grad=True)
+        pos_cluster_idx = [int(torch.randint(n_clusters, (1,), generator=g)) for _ in range(n)]
+        # variable-size negative sets, padded and masked inside the batched loss
+        neg_cluster_idx = [torch.randperm(n_clusters, generator=g)[:int(torch.randint(1, n_clusters, (1,), generator=g))] for _ in range(n)]
+
+        ref = reference_loss(embds, cluster_embds, pos_cluster_idx, neg_cluster_idx, 0.07)
+        ref_grads = torch.autograd.grad(ref, [embds, cluster_embds])
+        loss = CLBert.loss_cluster_instance(None, embds, cluster_embds, pos_cluster_idx, neg_cluster_idx, temperature=0.07)
+        grads = torch.autograd.grad(loss, [embds, cluster_embds])
+
+        assert torch.allclose(loss, ref)
+        assert all(torch.allclose(a, b) for a, b in zip(grads, ref_grads))
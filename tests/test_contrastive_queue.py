@@ -0,0 +1,34 @@
+import torch
+import torch.nn.functional as F
+
+from utils.contrastive import SupConLoss
+from utils.memory import FeatureQueue
+
+
+def make_batch(seed=0, bsz=8, dim=16):
+    g = torch.Generator().manual_seed(seed)
+    features = F.normalize(torch.randn(bsz, 2, dim, generator=g), dim=-1)
+    queued = F.normalize(torch.randn(12, dim, generator=g), dim=-1)
+    return features, queued
+
+
+def test_bf16_anchors_with_fp32_queue():
+    # --bf16_weights with --neg_queue_size > 0 and no autocast: bf16 anchors against the fp32 queue
+    features, queued = make_batch()
+    queue = FeatureQueue(12, 'cpu')
+    queue.enqueue(queued.bfloat16(), torch.arange(12), torch.zeros(12, dtype=torch.long))
+    assert queue.features.dtype == torch.float32
+
+    criterion = SupConLoss(temperature=0.5, base_temperature=0.5)
+    loss_bf16 = criterion(features.bfloat16(), queue=queue.features)
+    loss_fp32 = criterion(features, queue=queue.features)
+    assert torch.isfinite(loss_bf16)
+    assert torch.allclose(loss_bf16.float(), loss_fp32, atol=5e-2)
+
+
+def test_queue_adds_contrast_columns():
+    features, queued = make_batch(seed=1)
+    criterion = SupConLoss(temperature=0.5, base_temperature=0.5)
+    # an empty queue leaves the loss unchanged, a non-empty one adds negatives
+    assert torch.allclose(criterion(features, queue=queued[:0]), criterion(features))
+    assert not torch.allclose(criterion(features, queue=queued), criterion(features))
@@ -0,0 +1,179 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import openai
+import pytest
+import requests
+
+from init_parameter import init_model
+from utils.llm import LLMClient, LLMUnavailableError, run_concurrently
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """OpenAI-style chat completion endpoint answering with the queued failure statuses first"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers=()):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            status = server.failures.pop(0) if server.failures else 200
+        if status != 200:
+            headers = [('Retry-After', str(server.retry_after))] if status == 429 else []
+            self.reply(status, {'error': {'message': f'status {status}', 'type': 'stub'}}, headers)
+            return
+        self.reply(200, {'id': 'stub', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4o-mini',
+                         'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': 'ok'}, 'finish_reason': 'stop'}],
+                         'usage': {'prompt_tokens': 7, 'completion_tokens': 1, 'total_tokens': 8}})
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.failures = []
+    server.retry_after = 0.3
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(port, *extra):
+    args = init_model().parse_args(['--dataset', 'stub', '--known_cls_ratio', '0.5', '--llm', 'gpt-4o-mini', '--api_key', 'key',
+                                    '--llm_base_url', f'http://127.0.0.1:{port}/v1', '--disable_llm_cache',
+                                    '--llm_max_retries', '3', '--llm_backoff_base', '0.05', '--llm_max_backoff', '1',
+                                    '--llm_breaker_threshold', '2', '--llm_breaker_cooldown', '0.5', *extra])
+    return LLMClient(args)
+
+
+def test_openai_clients_share_a_pooled_session(server):
+    make_client(server.server_port)
+    session = openai.requestssession
+    assert isinstance(session, requests.Session)
+    make_client(server.server_port, '--llm_concurrency', '32')
+    assert openai.requestssession is session
+    assert session.get_adapter('http://127.0.0.1').poolmanager.connection_pool_kw['maxsize'] == 32
+
+
+def test_rate_limit_respects_retry_after(server):
+    client = make_client(server.server_port)
+    server.failures = [429, 429]
+    record = {}
+    start = time.monotonic()
+    assert client.complete('prompt', record=record) == 'ok'
+    assert time.monotonic() - start >= 2 * server.retry_after
+    assert record == {'retries': 2, 'prompt_tokens': 7, 'completion_tokens': 1}
+    assert server.requests == 3
+
+
+def test_server_errors_back_off(server, monkeypatch):
+    client = make_client(server.server_port)
+    sleeps = []
+
+    def backoff(attempt, e):
+        sleeps.append(LLMClient.backoff(client, attempt, e))
+        return sleeps[-1]
+    monkeypatch.setattr(client, 'backoff', backoff)
+    server.failures = [503, 500, 502]
+    assert client.complete('prompt') == 'ok'
+    assert server.requests == 4
+    # full jitter within the exponential cap
+    assert all(0 <= delay <= 0.05 * 2 ** attempt for attempt, delay in enumerate(sleeps))
+    assert client.stats()['retries'] == 3
+    assert client.breaker.failures == 0
+
+
+def test_breaker_opens_and_closes(server):
+    client = make_client(server.server_port, '--llm_max_retries', '1')
+    server.failures = [503] * 4
+    for _ in range(2):
+        with pytest.raises(openai.error.OpenAIError):
+            client.complete('prompt')
+    requests = server.requests
+    # open: rejected without sending a request
+    with pytest.raises(LLMUnavailableError):
+        client.complete('prompt')
+    assert server.requests == requests
+    assert client.stats()['rejected'] == 1
+    # half-open after the cooldown, a success closes it
+    time.sleep(0.6)
+    assert client.complete('prompt') == 'ok'
+    assert client.breaker.failures == 0
+    assert client.complete('prompt') == 'ok'
+
+
+def test_client_errors_are_not_retried(server):
+    client = make_client(server.server_port)
+    server.failures = [400, 400, 400]
+    for _ in range(3):
+        with pytest.raises(openai.error.InvalidRequestError):
+            client.complete('prompt')
+    assert server.requests == 3
+    assert client.stats()['retries'] == 0
+    assert client.breaker.failures == 0
+
+
+def test_other_exceptions_are_raised_right_away(server, monkeypatch):
+    client = make_client(server.server_port)
+
+    def broken(messages, max_tokens):
+        raise KeyError('content')
+    monkeypatch.setattr(client, 'request', broken)
+    start = time.monotonic()
+    with pytest.raises(KeyError):
+        client.complete('prompt')
+    assert time.monotonic() - start < 0.05
+    assert client.stats() == {'requests': 1, 'retries': 0, 'failures': 1, 'rejected': 0}
+    assert client.breaker.failures == 0
+
+
+def test_connection_errors_are_retried():
+    # a port nobody listens on
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    client = make_client(port, '--llm_max_retries', '2')
+    with pytest.raises(openai.error.APIConnectionError):
+        client.complete('prompt')
+    assert client.stats()['retries'] == 2
+    assert client.breaker.failures == 1
+
+
+def test_run_concurrently_keeps_job_order():
+    in_flight = []
+    lock = threading.Lock()
+
+    def job(i, delay):
+        with lock:
+            in_flight.append(1)
+            peak = len(in_flight)
+        time.sleep(delay)
+        with lock:
+            in_flight.pop()
+        return i, peak
+
+    # later jobs finish first
+    results = run_concurrently(job, [(i, 0.05 * (8 - i)) for i in range(8)], max_workers=4)
+    assert [i for i, _ in results] == list(range(8))
+    assert max(peak for _, peak in results) <= 4
@@ -0,0 +1,107 @@
+"""
+Mixed-precision and gradient-accumulation training steps shared by ModelManager and PretrainModelManager.
+"""
+import contextlib
+import torch
+import torch.nn as nn
+from utils.tools import get_amp_dtype
+
+# torch.cuda.amp.GradScaler is deprecated in recent torch releases
+GradScaler = torch.amp.GradScaler if hasattr(torch.amp, 'GradScaler') else torch.cuda.amp.GradScaler
+
+
+class TrainingStep(object):
+    """
+    Wrap the optimizer / scheduler pair of a manager:
+    - autocast the forward and loss computation with amp_dtype (bf16 | fp16, None for full precision),
+      with dynamic loss scaling for fp16 on cuda
+    - accumulate gradients over grad_accum_steps micro-batches before clipping and updating
+    - with fp32_master_weights, the optimizer updates fp32 copies of low-precision (e.g. bf16) model weights,
+      which are copied back to the model after every update
+    The optimizer must not have taken any step yet, its param groups are rebound to the master weights.
+    master_weights maps parameters to the fp32 weights taken before the low-precision cast (see cast_weights),
+    parameters without an entry start from an fp32 copy of their current value.
+    """
+    def __init__(self, optimizer, scheduler, device, amp_dtype=None, grad_accum_steps=1, grad_clip=1.0, fp32_master_weights=False,
+                 master_weights=None):
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.device = device
+        self.amp_dtype = amp_dtype
+        self.grad_accum_steps = max(1, grad_accum_steps)
+        self.grad_clip = grad_clip
+        self.scaler = GradScaler(enabled=amp_dtype == torch.float16 and device.type == 'cuda')
+        self.micro_step = 0
+
+        self.model_params, self.master_params = [], []
+        if fp32_master_weights:
+            for group in self.optimizer.param_groups:
+                masters = []
+                for p in group['params']:
+                    master = master_weights[p] if master_weights is not None and p in master_weights else p.detach().clone().float()
+                    master.requires_grad_(p.requires_grad)
+                    self.model_params.append(p)
+                    self.master_params.append(master)
+                    masters.append(master)
+                group['params'] = masters
+
+    def autocast(self):
+        if self.amp_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype)
+
+    def backward(self, loss):
+        """accumulate the gradients of one micro-batch, return True when the parameters have been updated"""
+        self.scaler.scale(loss / self.grad_accum_steps).backward()
+        self.micro_step += 1
+        if self.micro_step % self.grad_accum_steps != 0:
+            return False
+        self.step()
+        return True
+
+    def step(self):
+        if self.master_params:
+            for p, master in zip(self.model_params, self.master_params):
+                master.grad = p.grad.float() if p.grad is not None else None
+                p.grad = None
+            params = self.master_params
+        else:
+            params = [p for group in self.optimizer.param_groups for p in group['params']]
+
+        self.scaler.unscale_(self.optimizer)
+        nn.utils.clip_grad_norm_(params, self.grad_clip)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.scheduler.step()
+        self.optimizer.zero_grad()
+
+        if self.master_params:
+            with torch.no_grad():
+                for p, master in zip(self.model_params, self.master_params):
+                    p.copy_(master)
+
+    def flush(self):
+        """update with the gradients left over from an incomplete accumulation, e.g. at the end of an epoch"""
+        if self.micro_step % self.grad_accum_steps != 0:
+            self.step()
+        self.micro_step = 0
+
+
+def cast_weights(model, dtype, keep_fp32=False):
+    """
+    cast the model weights to dtype in place. With keep_fp32, return fp32 copies of the weights taken before the cast
+    (keyed by parameter) to initialize the master weights, so they do not start from the rounded values.
+    """
+    masters = {p: p.detach().clone().float() for p in model.parameters()} if keep_fp32 else None
+    model.to(dtype)
+    return masters
+
+
+def get_training_step(args, optimizer, scheduler, device, grad_clip, master_weights=None):
+    """training step configured by --amp_dtype, --grad_accum_steps, --bf16_weights and --fp32_master_weights"""
+    amp_dtype = get_amp_dtype(args.amp_dtype)
+    if args.fp32_master_weights and not args.bf16_weights:
+        print('--fp32_master_weights has no effect without --bf16_weights, the model weights are already fp32')
+    return TrainingStep(optimizer, scheduler, device, amp_dtype=amp_dtype, grad_accum_steps=args.grad_accum_steps,
+                        grad_clip=grad_clip, fp32_master_weights=args.fp32_master_weights and args.bf16_weights, master_weights=master_weights)
+
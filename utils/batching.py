@@ -0,0 +1,73 @@
+"""
+Dynamic padding and length-bucketed batching: batches are trimmed to their longest real sequence,
+and the bucketing sampler groups sequences of similar length so the trimmed batches carry little padding.
+Also the DataLoader worker options shared by the loaders.
+"""
+import math
+import random
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from torch.utils.data._utils.collate import default_collate
+
+
+def trim_padding(input_ids, input_mask, segment_ids):
+    """drop the trailing columns that are padding in every sequence of the batch"""
+    length = int(input_mask.any(dim=0).nonzero().max()) + 1 if input_mask.any() else 1
+    return input_ids[:, :length], input_mask[:, :length], segment_ids[:, :length]
+
+
+def dynamic_padding_collate(batch):
+    """collate (input_ids, input_mask, segment_ids, label_ids) samples into a batch trimmed to its longest sequence"""
+    input_ids, input_mask, segment_ids, label_ids = default_collate(batch)
+    return (*trim_padding(input_ids, input_mask, segment_ids), label_ids)
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler over sequence lengths.
+    Without shuffle, batches follow the (stable) length order and are the same in every epoch, which extract_features
+    relies on to scatter the outputs back to dataset order. With shuffle, the indices are permuted, sorted by length
+    within pools of batch_size * bucket_size_multiplier, and the resulting batches are permuted again.
+    """
+    def __init__(self, lengths, batch_size, shuffle=False, bucket_size_multiplier=50):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = batch_size * bucket_size_multiplier
+
+    def __iter__(self):
+        n = len(self.lengths)
+        if not self.shuffle:
+            order = np.argsort(self.lengths, kind='stable')
+            batches = [order[i:i + self.batch_size] for i in range(0, n, self.batch_size)]
+        else:
+            # seeded from the torch RNG like RandomSampler, so seeded runs stay reproducible
+            rng = np.random.RandomState(int(torch.empty((), dtype=torch.int64).random_().item()) % 2**32)
+            perm = rng.permutation(n)
+            batches = []
+            for start in range(0, n, self.pool_size):
+                pool = perm[start:start + self.pool_size]
+                pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+                batches.extend(pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size))
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+
+def seed_worker(worker_id):
+    """seed numpy and random of a DataLoader worker from its torch seed, which differs per worker and epoch"""
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def get_loader_kwargs(args):
+    """DataLoader options for args.num_workers worker processes, pinned memory and prefetching"""
+    if args.num_workers <= 0:
+        return {'pin_memory': args.pin_memory}
+    return {'num_workers': args.num_workers, 'pin_memory': args.pin_memory, 'persistent_workers': args.persistent_workers,
+            'prefetch_factor': args.prefetch_factor, 'worker_init_fn': seed_worker}
@@ -0,0 +1,148 @@
+import os
+import time
+import atexit
+import multiprocessing
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from threadpoolctl import threadpool_limits
+
+_sub_kmeans_pool = None
+_sub_kmeans_workers = 0
+
+
+class ClusteringStage(object):
+    """
+    K-Means stage run at every training round, exposing labels_ and cluster_centers_ like sklearn's KMeans.
+    With warm_start, each round is initialized from the previous round: the previous assignments are reused to
+    recompute the centers on the new features (falling back to the previous centers for empty clusters).
+    backend: sklearn | minibatch | torch (Lloyd iterations on the GPU when available)
+    """
+    def __init__(self, n_clusters, backend='sklearn', warm_start=False, seed=0, max_iter=300, tol=1e-4, batch_size=1024, name=''):
+        self.n_clusters = n_clusters
+        self.backend = backend
+        self.warm_start = warm_start
+        self.seed = seed
+        self.max_iter = max_iter
+        self.tol = tol
+        self.batch_size = batch_size
+        self.name = name
+        self.labels_ = None
+        self.cluster_centers_ = None
+        self.fit_time = 0.0
+
+    def init_centers(self, feats):
+        """warm-start centers from the previous round, or None for a cold start"""
+        if not self.warm_start or self.cluster_centers_ is None:
+            return None
+        centers = self.cluster_centers_.astype(feats.dtype)
+        if self.labels_ is not None and len(self.labels_) == len(feats):
+            counts = np.bincount(self.labels_, minlength=self.n_clusters)
+            sums = np.zeros((self.n_clusters, feats.shape[1]), dtype=np.float64)
+            np.add.at(sums, self.labels_, feats)
+            nonempty = counts > 0
+            centers = centers.copy()
+            centers[nonempty] = (sums[nonempty] / counts[nonempty, None]).astype(feats.dtype)
+        return centers
+
+    def fit(self, feats):
+        start = time.time()
+        init = self.init_centers(feats)
+        if self.backend == 'sklearn':
+            if init is None:
+                km = KMeans(n_clusters=self.n_clusters, random_state=self.seed).fit(feats)
+            else:
+                km = KMeans(n_clusters=self.n_clusters, init=init, n_init=1, random_state=self.seed).fit(feats)
+            self.labels_, self.cluster_centers_, self.n_iter_ = km.labels_, km.cluster_centers_, km.n_iter_
+        elif self.backend == 'minibatch':
+            km = MiniBatchKMeans(n_clusters=self.n_clusters, init='k-means++' if init is None else init, n_init=3 if init is None else 1,
+                                 batch_size=self.batch_size, max_iter=self.max_iter, random_state=self.seed).fit(feats)
+            self.labels_, self.cluster_centers_, self.n_iter_ = km.labels_, km.cluster_centers_, km.n_iter_
+        elif self.backend == 'torch':
+            self.labels_, self.cluster_centers_, self.n_iter_ = self.torch_kmeans(feats, init)
+        else:
+            raise NotImplementedError(f"Clustering backend {self.backend} not implemented!")
+        self.fit_time = time.time() - start
+        print(f'K-Means ({self.name}, {self.backend}, warm start: {init is not None}) converged in {self.n_iter_} iterations, {self.fit_time:.2f}s')
+        return self
+
+    @torch.no_grad()
+    def torch_kmeans(self, feats, init=None):
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        x = torch.as_tensor(feats, dtype=torch.float32).to(device)
+        generator = torch.Generator(device='cpu').manual_seed(self.seed)
+        centers = self.kmeans_plusplus(x, generator) if init is None else torch.as_tensor(init, dtype=torch.float32).to(device)
+
+        x_sq = torch.sum(x ** 2, dim=1, keepdim=True)
+        labels = None
+        for n_iter in range(1, self.max_iter + 1):
+            dist = x_sq + torch.sum(centers ** 2, dim=1).unsqueeze(0) - 2 * x.mm(centers.t())
+            new_labels = torch.argmin(dist, dim=1)
+            counts = torch.bincount(new_labels, minlength=self.n_clusters)
+            sums = torch.zeros_like(centers).index_add_(0, new_labels, x)
+            # keep the previous center for empty clusters
+            new_centers = torch.where(counts.unsqueeze(1) > 0, sums / counts.clamp(min=1).unsqueeze(1), centers)
+            shift = torch.sum((new_centers - centers) ** 2)
+            centers = new_centers
+            converged = labels is not None and torch.equal(new_labels, labels)
+            labels = new_labels
+            if converged or shift <= self.tol:
+                break
+        return labels.cpu().numpy(), centers.cpu().numpy(), n_iter
+
+    def kmeans_plusplus(self, x, generator):
+        n = x.shape[0]
+        first = torch.randint(n, (1,), generator=generator).item()
+        centers = [x[first]]
+        closest = torch.sum((x - x[first]) ** 2, dim=1)
+        for _ in range(1, self.n_clusters):
+            probs = (closest / closest.sum()).cpu()
+            idx = torch.multinomial(probs, 1, generator=generator).item()
+            centers.append(x[idx])
+            closest = torch.minimum(closest, torch.sum((x - x[idx]) ** 2, dim=1))
+        return torch.stack(centers)
+
+
+def get_clustering_stage(args, n_clusters, name=''):
+    return ClusteringStage(n_clusters, backend=args.kmeans_backend, warm_start=args.kmeans_warm_start, seed=args.seed,
+                           max_iter=args.kmeans_max_iter, batch_size=args.kmeans_batch_size, name=name)
+
+
+def fit_sub_kmeans(feats, n_clusters, seed):
+    """centers of one sklearn KMeans fit, module level so it can run in a worker process"""
+    return KMeans(n_clusters=n_clusters, random_state=seed).fit(feats).cluster_centers_
+
+
+def limit_worker_threads(threads):
+    """pool initializer: split the cores between the workers instead of letting every KMeans use all of them"""
+    threadpool_limits(limits=threads)
+
+
+def shutdown_sub_kmeans_pool():
+    global _sub_kmeans_pool
+    if _sub_kmeans_pool is not None:
+        _sub_kmeans_pool.shutdown()
+        _sub_kmeans_pool = None
+
+
+def sub_kmeans_centers(groups, n_clusters, seed, workers=1):
+    """
+    Fit one KMeans per feature group (e.g. the members of every cluster) and return the centers in group order.
+    With workers > 1 the fits run in a process pool that is kept for the later rounds (and shut down at exit),
+    each worker limited to cpu_count / workers BLAS / OpenMP threads. The pool is spawned rather than forked,
+    since forking after OpenMP / CUDA have been initialized in the parent can hang the workers.
+    """
+    global _sub_kmeans_pool, _sub_kmeans_workers
+    if workers <= 1 or len(groups) <= 1:
+        return [fit_sub_kmeans(g, k, seed) for g, k in zip(groups, n_clusters)]
+    if _sub_kmeans_pool is not None and _sub_kmeans_workers != workers:
+        shutdown_sub_kmeans_pool()
+    if _sub_kmeans_pool is None:
+        _sub_kmeans_workers = workers
+        _sub_kmeans_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                               initializer=limit_worker_threads, initargs=(max(1, (os.cpu_count() or 1) // workers),))
+    return list(_sub_kmeans_pool.map(fit_sub_kmeans, groups, n_clusters, [seed] * len(groups)))
+
+
+atexit.register(shutdown_sub_kmeans_pool)
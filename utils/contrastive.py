@@ -9,13 +9,15 @@ class SupConLoss(nn.Module):
         self.contrast_mode = contrast_mode
         self.base_temperature = base_temperature
 
-    def forward(self, features, labels=None, mask=None):
+    def forward(self, features, labels=None, mask=None, queue=None, queue_mask=None):
         """If both `labels` and `mask` are None, it degenerates to SimCLR unsupervised loss: https://arxiv.org/pdf/2002.05709.pdf. 
         Args:
             features: hidden vector of shape [bsz, n_views, ...].
             labels: ground truth of shape [bsz].
             mask: contrastive mask of shape [bsz, bsz], mask_{i,j}=1 if sample j
                 has the same class as sample i. Can be asymmetric.
+            queue: features of previous steps of shape [n_queue, ...], used as extra contrast samples.
+            queue_mask: contrastive mask of shape [bsz, n_queue] between the batch and the queue, all negatives if None.
         Returns:
             A loss scalar.
         """
@@ -72,6 +74,16 @@ class SupConLoss(nn.Module):
         )
         mask = mask * logits_mask
 
+        # append the queued features as extra contrast columns
+        if queue is not None and len(queue) > 0:
+            # the queue is stored in fp32, match the anchors when the weights run in bf16
+            queue = queue.view(queue.shape[0], -1).detach().to(anchor_feature.dtype)
+            queue_dot_contrast = torch.div(torch.matmul(anchor_feature, queue.T), self.temperature)
+            queue_mask = torch.zeros(batch_size, queue.shape[0], device=device) if queue_mask is None else queue_mask.float().to(device)
+            logits = torch.cat([logits, queue_dot_contrast - logits_max.detach()], dim=1)
+            mask = torch.cat([mask, queue_mask.repeat(anchor_count, 1)], dim=1)
+            logits_mask = torch.cat([logits_mask, torch.ones_like(queue_dot_contrast)], dim=1)
+
         # compute log_prob
         exp_logits = torch.exp(logits) * logits_mask
         log_prob = logits - torch.log(exp_logits.sum(1, keepdim=True))
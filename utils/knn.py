@@ -0,0 +1,132 @@
+"""
+kNN index backends for mining the nearest neighbors of the memory bank features.
+All backends rank by inner product and return (distances, indices) numpy arrays like faiss.
+"""
+import time
+import numpy as np
+import torch
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+
+class TorchKNNIndex(object):
+    """exact inner product search with blocked matmul, used when faiss is not installed"""
+    def __init__(self, dim, device='auto', block_size=1024):
+        self.dim = dim
+        if device == 'auto':
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        device = 'cuda' if device == 'gpu' else device
+        if device.startswith('cuda') and not torch.cuda.is_available():
+            print('kNN device gpu requested but CUDA is not available, falling back to CPU')
+            device = 'cpu'
+        self.device = torch.device(device)
+        self.block_size = block_size
+        self.features = None
+
+    def add(self, features):
+        self.features = torch.as_tensor(features, dtype=torch.float32).to(self.device)
+
+    @torch.no_grad()
+    def search(self, queries, k):
+        queries = torch.as_tensor(queries, dtype=torch.float32)
+        distances = np.empty((queries.shape[0], k), dtype=np.float32)
+        indices = np.empty((queries.shape[0], k), dtype=np.int64)
+        for start in range(0, queries.shape[0], self.block_size):
+            block = queries[start:start + self.block_size].to(self.device)
+            sim, ind = torch.topk(block.mm(self.features.t()), k, dim=1, largest=True, sorted=True)
+            distances[start:start + block.shape[0]] = sim.cpu().numpy()
+            indices[start:start + block.shape[0]] = ind.cpu().numpy()
+        return distances, indices
+
+
+class FaissKNNIndex(object):
+    """
+    faiss inner product index on CPU or GPU:
+    'flat' is the exact brute-force search, 'ivf' and 'hnsw' are approximate and tuned with nprobe / efSearch.
+    """
+    def __init__(self, dim, index_type='flat', device='auto', nlist=0, nprobe=8, hnsw_m=32, ef_search=128):
+        self.dim = dim
+        self.index_type = index_type
+        num_gpus = faiss.get_num_gpus() if hasattr(faiss, 'get_num_gpus') else 0
+        if device == 'auto':
+            device = 'gpu' if num_gpus > 0 else 'cpu'
+        if device == 'gpu' and num_gpus == 0:
+            print('kNN device gpu requested but faiss sees no GPU, falling back to CPU')
+        elif device == 'gpu' and index_type == 'hnsw':
+            # faiss has no GPU implementation of HNSW
+            print('faiss has no GPU HNSW index, falling back to CPU')
+        self.use_gpu = device == 'gpu' and num_gpus > 0 and index_type != 'hnsw'
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.index = None
+
+    def add(self, features):
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        if self.index_type == 'flat':
+            index = faiss.IndexFlatIP(self.dim)
+        elif self.index_type == 'ivf':
+            nlist = self.nlist if self.nlist > 0 else max(1, int(4 * np.sqrt(features.shape[0])))
+            nlist = min(nlist, features.shape[0])
+            self.quantizer = faiss.IndexFlatIP(self.dim)
+            index = faiss.IndexIVFFlat(self.quantizer, self.dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            index.nprobe = self.nprobe
+        elif self.index_type == 'hnsw':
+            index = faiss.IndexHNSWFlat(self.dim, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efSearch = self.ef_search
+        else:
+            raise NotImplementedError(f"kNN index {self.index_type} not implemented!")
+
+        if self.use_gpu:
+            index = faiss.index_cpu_to_all_gpus(index)
+            if self.index_type == 'ivf':
+                faiss.GpuParameterSpace().set_index_parameter(index, 'nprobe', self.nprobe)
+        if not index.is_trained:
+            index.train(features)
+        index.add(features)
+        self.index = index
+
+    def search(self, queries, k):
+        return self.index.search(np.ascontiguousarray(queries, dtype=np.float32), k)
+
+
+def build_knn_index(args, dim):
+    """
+    build the kNN index chosen by args.knn_backend:
+    auto (exact faiss if installed, otherwise torch) | flat | ivf | hnsw | torch
+    """
+    backend = args.knn_backend
+    if backend == 'auto':
+        backend = 'flat' if faiss is not None else 'torch'
+    if backend != 'torch' and faiss is None:
+        print(f'faiss is not installed, falling back from kNN backend {backend} to torch')
+        backend = 'torch'
+
+    if backend == 'torch':
+        return TorchKNNIndex(dim, device=args.knn_device)
+    return FaissKNNIndex(dim, index_type=backend, device=args.knn_device, nlist=args.knn_nlist,
+                         nprobe=args.knn_nprobe, hnsw_m=args.knn_hnsw_m, ef_search=args.knn_ef_search)
+
+
+def knn_recall(indices, exact_indices):
+    """mean recall@k of the retrieved neighbor indices w.r.t. the exact ones"""
+    k = exact_indices.shape[1]
+    hits = [len(np.intersect1d(a, b)) for a, b in zip(indices, exact_indices)]
+    return float(np.sum(hits)) / (k * len(exact_indices))
+
+
+def report_knn_recall(features, indices, k, num_queries=1000, seed=0):
+    """compare the neighbors of a random subset of queries with the exact search and return recall@k"""
+    rng = np.random.RandomState(seed)
+    sample = rng.choice(features.shape[0], min(num_queries, features.shape[0]), replace=False)
+    exact = TorchKNNIndex(features.shape[1])
+    exact.add(features)
+    start = time.time()
+    _, exact_indices = exact.search(features[sample], k)
+    recall = knn_recall(indices[sample], exact_indices)
+    print(f'kNN recall@{k} against exact search on {len(sample)} queries: {recall:.4f} ({time.time() - start:.2f}s)')
+    return recall
@@ -0,0 +1,300 @@
+import time
+import random
+import threading
+import openai
+import requests
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from together import Together
+from together import error as together_error
+from utils.llm_cache import get_llm_cache
+from utils.llm_telemetry import get_llm_telemetry
+
+_clients = {}
+_clients_lock = threading.Lock()
+_session_lock = threading.Lock()
+_session_pool_size = {}
+
+# provider errors with these HTTP status codes are retried, as well as timeouts and connection errors,
+# any other exception (a client error, a bug in the caller) is raised right away
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+TRANSIENT_ERRORS = (openai.error.Timeout, openai.error.APIConnectionError, together_error.Timeout, together_error.APIConnectionError,
+                    requests.exceptions.Timeout, requests.exceptions.ConnectionError)
+API_ERRORS = (openai.error.OpenAIError, together_error.TogetherException)
+
+
+class LLMUnavailableError(Exception):
+    """raised without sending a request while the circuit breaker is open"""
+
+
+class TokenBucket(object):
+    """thread-safe token bucket holding at most one minute of budget, a rate of 0 disables the limit"""
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """block until amount tokens are available and take them, return the time waited"""
+        if self.capacity <= 0:
+            return 0.0
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class CircuitBreaker(object):
+    """
+    Opens after threshold consecutive failed calls and rejects calls for cooldown seconds.
+    After the cooldown calls go through again (half-open): a success closes the breaker, a failure reopens it.
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        with self.lock:
+            if self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown:
+                raise LLMUnavailableError(f'circuit breaker open after {self.failures} consecutive failures')
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.threshold > 0 and self.failures >= self.threshold:
+                if self.opened_at is None or time.monotonic() - self.opened_at >= self.cooldown:
+                    print(f'LLM circuit breaker opened for {self.cooldown}s after {self.failures} consecutive failures')
+                self.opened_at = time.monotonic()
+
+
+def use_pooled_openai_session(pool_size):
+    """
+    openai<1.0 builds the requests session of every thread from openai.requestssession, install one pooled session
+    shared by all threads and OpenAI clients (the api key and base url are sent with every request, not by the session).
+    A session set by the user is left alone.
+    """
+    with _session_lock:
+        if openai.requestssession is None:
+            openai.requestssession = requests.Session()
+            _session_pool_size['size'] = 0
+        elif 'size' not in _session_pool_size:
+            return
+        if pool_size > _session_pool_size['size']:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+            openai.requestssession.mount('https://', adapter)
+            openai.requestssession.mount('http://', adapter)
+            _session_pool_size['size'] = pool_size
+
+
+class LLMClient(object):
+    """
+    One client per (llm, base url, api key), shared by all threads of the process.
+    The provider client and its HTTP connections are reused across requests, requests and estimated tokens are
+    rate limited with token buckets, failed requests are retried with exponential backoff and full jitter
+    (or the server's Retry-After), and a circuit breaker stops sending requests to a failing provider.
+    """
+    def __init__(self, args):
+        self.llm = args.llm
+        self.api_key = args.api_key
+        self.base_url = args.llm_base_url
+        self.max_retries = args.llm_max_retries
+        self.backoff_base = args.llm_backoff_base
+        self.max_backoff = args.llm_max_backoff
+        self.request_bucket = TokenBucket(args.llm_rpm)
+        self.token_bucket = TokenBucket(args.llm_tpm)
+        self.breaker = CircuitBreaker(args.llm_breaker_threshold, args.llm_breaker_cooldown)
+        # own RNG for the jitter, so retries do not shift the seeded global random state
+        self.rng = random.Random()
+        self.counts = {'requests': 0, 'retries': 0, 'failures': 0, 'rejected': 0}
+        self.lock = threading.Lock()
+
+        if 'gpt' not in self.llm:
+            # retries are handled here, not by the provider client
+            kwargs = {'base_url': self.base_url} if self.base_url else {}
+            self.together = Together(api_key=self.api_key, max_retries=0, **kwargs)
+        else:
+            use_pooled_openai_session(max(10, args.llm_concurrency))
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def request(self, messages, max_tokens):
+        """return the completion text and the (prompt, completion) tokens reported by the provider"""
+        if 'gpt' not in self.llm:
+            completion = self.together.chat.completions.create(
+                model=self.llm,
+                messages=messages,
+                temperature=0.0,
+                top_p=1.0,
+                n=1,
+                max_tokens=max_tokens
+            )
+            usage = getattr(completion, 'usage', None)
+            tokens = (usage.prompt_tokens, usage.completion_tokens) if usage is not None else (0, 0)
+            return completion.choices[0].message.content, tokens
+        completion = openai.ChatCompletion.create(
+            model=self.llm,  # 'gpt-4o-mini', # "gpt-3.5-turbo",
+            messages=messages,
+            temperature=0.0,  # Set to 0 to remove randomness
+            top_p=1.0,        # Use top_p sampling with the full range of tokens
+            n=1,               # Number of responses to generate
+            max_tokens=max_tokens,     # Set a lower max_tokens value to limit response length and avoid timeout
+            api_key=self.api_key,
+            api_base=self.base_url
+        )
+        usage = completion.get('usage') or {}
+        return completion.choices[0].message['content'], (usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0))
+
+    @staticmethod
+    def status(e):
+        status = getattr(e, 'http_status', None) or getattr(e, 'status_code', None)
+        if status is None and getattr(e, 'response', None) is not None:
+            status = getattr(e.response, 'status_code', None)
+        return status
+
+    @classmethod
+    def retryable(cls, e):
+        """timeouts, connection errors and provider errors with a retryable HTTP status"""
+        if isinstance(e, TRANSIENT_ERRORS):
+            return True
+        return isinstance(e, API_ERRORS) and cls.status(e) in RETRYABLE_STATUS
+
+    @staticmethod
+    def retry_after(e):
+        """seconds requested by the Retry-After header of the failed response, or None"""
+        headers = getattr(e, 'headers', None)
+        if headers is None and getattr(e, 'response', None) is not None:
+            headers = getattr(e.response, 'headers', None)
+        if not headers:
+            return None
+        value = headers.get('Retry-After') or headers.get('retry-after')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                return None
+
+    def backoff(self, attempt, e):
+        retry_after = self.retry_after(e)
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return self.rng.uniform(0, min(self.max_backoff, self.backoff_base * 2 ** attempt))
+
+    def complete(self, prompt, max_tokens=50, record=None):
+        """return the completion text, the retries and token usage are written to the record dict if given"""
+        record = {} if record is None else record
+        record['retries'] = 0
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt}
+        ]
+        # rough token estimate of the request, ~4 characters per token plus the completion budget
+        tokens = len(prompt) // 4 + max_tokens
+        for attempt in range(self.max_retries + 1):
+            # checked before every attempt, so in-flight calls stop retrying once another thread opened the breaker
+            try:
+                self.breaker.check()
+            except LLMUnavailableError:
+                self.count('rejected')
+                raise
+            self.request_bucket.acquire(1)
+            self.token_bucket.acquire(tokens)
+            self.count('requests')
+            try:
+                content, (record['prompt_tokens'], record['completion_tokens']) = self.request(messages, max_tokens)
+            except Exception as e:
+                if not self.retryable(e):
+                    # client errors (e.g. a bad request) and bugs say nothing about the provider's health
+                    print(f"Attempt {attempt + 1} failed: {e}. Not retrying.")
+                    self.count('failures')
+                    raise
+                if attempt == self.max_retries:
+                    print(f"Attempt {attempt + 1} failed: {e}. No more retries left.")
+                    self.count('failures')
+                    self.breaker.record_failure()
+                    raise
+                delay = self.backoff(attempt, e)
+                print(f"Attempt {attempt + 1} failed: {e}. Retrying in {delay:.2f} seconds...")
+                self.count('retries')
+                record['retries'] += 1
+                time.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return content
+
+
+def get_llm_client(args):
+    """return the shared LLMClient of this process for args.llm"""
+    key = (args.llm, args.llm_base_url, args.api_key)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = LLMClient(args)
+        return _clients[key]
+
+
+def chat_completion(args, prompt, max_tokens=50, site='other'):
+    """
+    Send one deterministic (temperature 0) chat request to args.llm and return the completion text.
+    Responses are served from the persistent LLM cache when possible. Exceptions are raised to the caller
+    once the retries are exhausted, or right away as LLMUnavailableError while the circuit breaker is open.
+    Every call is recorded in the LLM telemetry under site.
+    """
+    telemetry = get_llm_telemetry(args)
+    start = time.time()
+    cache = get_llm_cache(args)
+    if cache is not None:
+        content = cache.get(args.llm, prompt)
+        if content is not None:
+            telemetry.record_call(site, time.time() - start, cached=True)
+            return content
+
+    record = {}
+    try:
+        content = get_llm_client(args).complete(prompt, max_tokens=max_tokens, record=record)
+    except Exception as e:
+        telemetry.record_call(site, time.time() - start, cached=False, retries=record.get('retries', 0), error=type(e).__name__)
+        raise
+    telemetry.record_call(site, time.time() - start, cached=False, prompt_tokens=record['prompt_tokens'],
+                          completion_tokens=record['completion_tokens'], retries=record['retries'])
+
+    if cache is not None:
+        cache.put(args.llm, prompt, content)
+    return content
+
+
+def run_concurrently(fn, jobs, max_workers):
+    """run fn(*job) for every job with at most max_workers requests in flight, keeping the job order"""
+    results = [None] * len(jobs)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(fn, *job): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
@@ -0,0 +1,117 @@
+import os
+import time
+import atexit
+import sqlite3
+import hashlib
+import threading
+
+
+class LLMCache(object):
+    """
+    Persistent LLM response cache keyed by (model, prompt hash).
+    Responses are stored in a SQLite database in WAL mode, so several run.sh jobs can share one cache file.
+    When the cache grows beyond max_entries, the least recently used responses are evicted, checked every evict_every inserts.
+    Cache hits only read the database: their last_access updates are buffered and written in one transaction per
+    flush_every hits (and before eviction and at exit), so readers of a shared cache do not queue on the write lock.
+    """
+    def __init__(self, path, max_entries=200000, timeout=60, evict_every=1000, flush_every=256):
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.evict_every = evict_every
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.pending_access = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self.connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, last_access REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.evict()
+        atexit.register(self.flush)
+
+    def connect(self):
+        # sqlite connections can not be shared across threads, keep one per thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def key(model, prompt):
+        return hashlib.sha256(f'{model}\x00{prompt}'.encode('utf-8')).hexdigest()
+
+    def get(self, model, prompt):
+        """return the cached response or None"""
+        conn = self.connect()
+        key = self.key(model, prompt)
+        row = conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        with self.lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.pending_access[key] = time.time()
+            flush = len(self.pending_access) >= self.flush_every
+        if flush:
+            self.flush()
+        return row[0]
+
+    def put(self, model, prompt, response):
+        conn = self.connect()
+        conn.execute("INSERT OR REPLACE INTO responses (key, model, response, last_access) VALUES (?, ?, ?, ?)",
+                     (self.key(model, prompt), model, response, time.time()))
+        with self.lock:
+            self.puts += 1
+            evict = self.puts % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def flush(self):
+        """write the buffered last_access updates of cache hits in one transaction"""
+        with self.lock:
+            pending, self.pending_access = self.pending_access, {}
+        if len(pending) == 0:
+            return
+        conn = self.connect()
+        conn.execute("BEGIN")
+        conn.executemany("UPDATE responses SET last_access = MAX(last_access, ?) WHERE key = ?", [(t, key) for key, t in pending.items()])
+        conn.execute("COMMIT")
+
+    def evict(self):
+        """drop the least recently used responses beyond max_entries"""
+        if self.max_entries is None or self.max_entries <= 0:
+            return
+        self.flush()
+        conn = self.connect()
+        size = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if size > self.max_entries:
+            conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                         (size - self.max_entries,))
+
+    def __len__(self):
+        return self.connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hits / total, 4) if total > 0 else 0.0, 'size': len(self)}
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_llm_cache(args):
+    """return the shared LLMCache of this process, or None if the cache is disabled"""
+    if args.disable_llm_cache or not args.llm_cache_path:
+        return None
+    with _caches_lock:
+        if args.llm_cache_path not in _caches:
+            _caches[args.llm_cache_path] = LLMCache(args.llm_cache_path, max_entries=args.llm_cache_max_entries)
+        return _caches[args.llm_cache_path]
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+
+
+class LLMTelemetry(object):
+    """
+    Per-round LLM telemetry: latency, prompt / completion tokens, retries, cache hits, fallbacks and parse failures
+    of every LLM call, grouped by call site (neighbor_selection, neighbor_selection_batch, cluster_instance, characterization).
+    Every call is appended to a JSONL trace if trace_path is given; round_summary() reduces the calls since the previous
+    summary into the llm_* columns of the results CSV and also appends the summary to the trace.
+    """
+    def __init__(self, trace_path=None, prompt_price=0.0, completion_price=0.0):
+        self.trace_path = trace_path
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self.round = 1
+        self.lock = threading.Lock()
+        self.reset()
+        if trace_path is not None and os.path.dirname(trace_path):
+            os.makedirs(os.path.dirname(trace_path), exist_ok=True)
+
+    def reset(self):
+        self.calls = []
+        self.fallbacks = {}
+        self.parse_failures = {}
+
+    def write(self, record):
+        if self.trace_path is None:
+            return
+        with open(self.trace_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def record_call(self, site, latency, cached, prompt_tokens=0, completion_tokens=0, retries=0, error=None):
+        record = {'event': 'call', 'round': self.round, 'time': time.time(), 'site': site, 'latency': round(latency, 4), 'cached': cached,
+                  'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'retries': retries, 'error': error}
+        with self.lock:
+            self.calls.append(record)
+            self.write(record)
+
+    def record_fallback(self, site, n=1):
+        """the caller used its default answer because the LLM call failed"""
+        with self.lock:
+            self.fallbacks[site] = self.fallbacks.get(site, 0) + n
+
+    def record_parse_failure(self, site, n=1):
+        """the LLM answered but the answer could not be parsed"""
+        with self.lock:
+            self.parse_failures[site] = self.parse_failures.get(site, 0) + n
+
+    def round_summary(self):
+        """summarize the calls since the previous summary and start a new round"""
+        with self.lock:
+            calls = self.calls
+            # latency percentiles over the requests actually sent, cache hits return in microseconds
+            latencies = np.array([c['latency'] for c in calls if not c['cached']])
+            prompt_tokens = sum(c['prompt_tokens'] for c in calls)
+            completion_tokens = sum(c['completion_tokens'] for c in calls)
+            summary = {
+                'llm_round': self.round,
+                'llm_calls': len(calls),
+                'llm_cache_hits': sum(c['cached'] for c in calls),
+                'llm_errors': sum(c['error'] is not None for c in calls),
+                'llm_retries': sum(c['retries'] for c in calls),
+                'llm_fallbacks': sum(self.fallbacks.values()),
+                'llm_parse_failures': sum(self.parse_failures.values()),
+                'llm_prompt_tokens': prompt_tokens,
+                'llm_completion_tokens': completion_tokens,
+                'llm_cost': round((prompt_tokens * self.prompt_price + completion_tokens * self.completion_price) / 1e6, 4),
+                'llm_time': round(float(latencies.sum()), 2),
+                'llm_latency_p50': round(float(np.percentile(latencies, 50)), 3) if len(latencies) > 0 else 0.0,
+                'llm_latency_p90': round(float(np.percentile(latencies, 90)), 3) if len(latencies) > 0 else 0.0,
+                'llm_latency_p99': round(float(np.percentile(latencies, 99)), 3) if len(latencies) > 0 else 0.0,
+            }
+            sites = sorted(set(c['site'] for c in calls) | set(self.fallbacks) | set(self.parse_failures))
+            self.write(dict(event='round_summary', time=time.time(), **summary, sites={
+                site: {'calls': sum(c['site'] == site for c in calls), 'fallbacks': self.fallbacks.get(site, 0),
+                       'parse_failures': self.parse_failures.get(site, 0)} for site in sites}))
+            self.reset()
+            self.round += 1
+        return summary
+
+
+_telemetry = {}
+_telemetry_lock = threading.Lock()
+
+def get_llm_telemetry(args):
+    """return the LLMTelemetry of this run, the JSONL trace is only written when args.llm_trace_path is given"""
+    with _telemetry_lock:
+        if 'run' not in _telemetry:
+            _telemetry['run'] = LLMTelemetry(args.llm_trace_path, prompt_price=args.llm_prompt_price, completion_price=args.llm_completion_price)
+        return _telemetry['run']
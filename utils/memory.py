@@ -10,6 +10,10 @@ from scipy.optimize import linear_sum_assignment
 import torch.nn.functional as F
 from heapq import nlargest
 import random
+import time
+from utils.knn import build_knn_index, report_knn_recall
+from utils.metrics import hungarian_alignment
+from utils.tools import extract_features
 
 class MemoryBank(object):
     def __init__(self, args, n, dim, num_classes, temperature):
@@ -51,21 +55,18 @@ class MemoryBank(object):
 
     def mine_nearest_neighbors(self, topk, y_pred, cluster_centers_):
         # mine the topk nearest neighbors for every sample
-        import faiss
         features = self.features.cpu().numpy()
         n, dim = features.shape[0], features.shape[1]
-        index = faiss.IndexFlatIP(dim)
-        index = faiss.index_cpu_to_all_gpus(index)
+        start = time.time()
+        index = build_knn_index(self.args, dim)
         index.add(features)
         distances, indices = index.search(features, topk+1) # Sample itself is included
+        print(f'Mined top-{topk} neighbors of {n} samples with {type(index).__name__} ({self.args.knn_backend}) in {time.time() - start:.2f}s')
+        if self.args.knn_report_recall:
+            report_knn_recall(features, indices, topk+1)
 
         # compute probability that samples belong to different clusters via Student's t-distribution
-        alpha =  1
-        q = 1.0 / (1.0 + torch.sum((self.features.unsqueeze(1) - cluster_centers_) ** 2, dim=2) / alpha)
-        q = q ** (alpha + 1.0) / 2.0
-        q = (q.t() / torch.sum(q, dim=1)).t()
-        weight = q ** 2 / torch.sum(q, dim=0)
-        p = (weight.t() / torch.sum(weight, dim=1)).t()
+        p = self.soft_assignment(cluster_centers_, chunk_size=self.args.soft_assign_chunk_size)
 
         # compute entropy
         entr = self.entropy(p)
@@ -77,15 +78,7 @@ class MemoryBank(object):
 
         # compute local inconsistency
         neighbor_pseudos = np.take(y_pred, indices[:,1:], axis=0)
-        anchor_pseudos = np.repeat(y_pred.reshape(-1,1), topk, axis=1)
-        temp = []
-        for i in range(neighbor_pseudos.shape[0]):
-            count = 0
-            for j in range(neighbor_pseudos.shape[1]):
-                    if neighbor_pseudos[i][j] != anchor_pseudos[i][j]:
-                        count += 1
-            temp.append(count)
-        temp = torch.tensor(temp)
+        temp = torch.from_numpy(np.sum(neighbor_pseudos != y_pred.reshape(-1, 1), axis=1).astype(np.int64))
         # local inconsistency degree sort
         _, index = torch.sort(temp, descending=True)
 
@@ -94,10 +87,10 @@ class MemoryBank(object):
 
         if self.args.sampling_strategy == 'loop':
             # default: all b samples with highest entropy & local inconsistency degree
-            query_index = []
-            for i in index[:self.args.query_samples]:
-                if i in inx[:self.args.query_samples]:
-                    query_index.append(i)
+            is_uncertain = torch.zeros(n, dtype=torch.bool)
+            is_uncertain[inx[:self.args.query_samples]] = True
+            query_index = index[:self.args.query_samples]
+            query_index = query_index[is_uncertain[query_index]].tolist()
 
         elif self.args.sampling_strategy == 'random':
             # randomly sample budget query samples from the dataset
@@ -144,32 +137,28 @@ class MemoryBank(object):
 
         elif self.args.sampling_strategy == 'equal_random':
             # sample equal number of query samples randomly from each cluster
-            cluster_budget = [self.args.query_samples // self.C] * self.C
-            # ensure the sum of allocations equals the budget: the remaining budget is allocated to the cluster randomly
-            while sum(cluster_budget) < self.args.query_samples:
-                cluster_budget[random.choice(range(self.C))] += 1
+            cluster_budget = self.equal_cluster_budget(self.args.query_samples)
             query_index = []
-            for i in range(self.C):
-                query_index.extend(random.sample(inx[cluster_assignment == i].tolist(), cluster_budget[i]))
+            for i, group in enumerate(self.group_by_cluster(inx.numpy(), cluster_assignment)):
+                query_index.extend(random.sample(group.tolist(), cluster_budget[i]))
 
         else:
             if self.args.sampling_strategy == 'equal_highest':
                 # equal allocation of query samples to each cluster
-                cluster_budget = [self.args.query_samples // self.C] * self.C
-                # ensure the sum of allocations equals the budget: the remaining budget is allocated to the cluster randomly
-                while sum(cluster_budget) < self.args.query_samples:
-                    cluster_budget[random.choice(range(self.C))] += 1
+                cluster_budget = self.equal_cluster_budget(self.args.query_samples)
 
             elif self.args.sampling_strategy == 'one_highest':
                 # take all the sample from a random cluster
                 cluster_budget = [0] * self.C
                 
-            # for each cluster, sample query samples with highest uncertainty based on the cluster budget
-            query_index = []
-            for i in range(self.C):
-                if cluster_budget[i] == 0:
-                    continue
-                query_index.extend(inx[cluster_assignment == i][:cluster_budget[i]].tolist())
+            # for each cluster, sample query samples with highest uncertainty based on the cluster budget:
+            # keep the entries whose rank inside their cluster group is below the cluster budget
+            order = np.argsort(cluster_assignment, kind='stable')
+            grouped_inx, grouped_cluster = inx.numpy()[order], cluster_assignment[order]
+            counts = np.bincount(cluster_assignment, minlength=self.C)
+            starts = np.cumsum(counts) - counts
+            rank = np.arange(len(order)) - starts[grouped_cluster]
+            query_index = grouped_inx[rank < np.asarray(cluster_budget)[grouped_cluster]].tolist()
         
 
         # print('\nQuery Index:', query_index)
@@ -177,6 +166,38 @@ class MemoryBank(object):
         return indices, query_index, p
     
 
+    def equal_cluster_budget(self, budget):
+        """equal allocation of the budget to each cluster, the remaining budget is allocated to clusters randomly"""
+        cluster_budget = [budget // self.C] * self.C
+        for _ in range(budget - sum(cluster_budget)):
+            cluster_budget[random.choice(range(self.C))] += 1
+        return cluster_budget
+
+    def group_by_cluster(self, values, cluster_assignment):
+        """split values into one array per cluster by cluster_assignment, keeping their order inside each cluster"""
+        order = np.argsort(cluster_assignment, kind='stable')
+        counts = np.bincount(cluster_assignment, minlength=self.C)
+        return np.split(values[order], np.cumsum(counts)[:-1])
+
+    def soft_assignment(self, cluster_centers_, alpha=1, chunk_size=4096):
+        """
+        Student's t soft assignment p (n x C) of the memory bank features to the cluster centers.
+        Squared distances are computed with the |a|^2 + |b|^2 - 2ab expansion in chunks over n,
+        so the peak memory is O(chunk_size x C) instead of O(n x C x dim).
+        """
+        centers = torch.as_tensor(cluster_centers_, device=self.features.device).double()
+        centers_sq = torch.sum(centers ** 2, dim=1)
+        q = torch.empty(self.features.shape[0], centers.shape[0], dtype=self.features.dtype, device=self.features.device)
+        for start in range(0, self.features.shape[0], chunk_size):
+            feats = self.features[start:start + chunk_size].double()
+            dist = torch.sum(feats ** 2, dim=1, keepdim=True) + centers_sq.unsqueeze(0) - 2 * feats.mm(centers.t())
+            q_chunk = 1.0 / (1.0 + dist.clamp_(min=0) / alpha)
+            q_chunk = q_chunk ** (alpha + 1.0) / 2.0
+            q[start:start + chunk_size] = q_chunk / torch.sum(q_chunk, dim=1, keepdim=True)
+        weight = q ** 2 / torch.sum(q, dim=0)
+        p = weight / torch.sum(weight, dim=1, keepdim=True)
+        return p
+
     def allocate_query_samples(self, difficulty_scores, budget, degree):
         degree = float(degree)
         difficulty_scores = torch.tensor(difficulty_scores, dtype=torch.float32)
@@ -219,13 +240,7 @@ class MemoryBank(object):
         self.to('cuda:0')
 
     def hungray_aligment(self, y_true, y_pred):
-        D = max(y_pred.max(), y_true.max()) + 1
-        w = np.zeros((D, D))
-        for i in range(y_pred.size):
-            w[y_pred[i], y_true[i]] += 1
-
-        ind = np.transpose(np.asarray(linear_sum_assignment(w.max() - w)))
-        return ind, w
+        return hungarian_alignment(y_true, y_pred)
 
     def entropy(self, x, eps=1e-5):
         p = F.softmax(x, dim=-1)
@@ -234,18 +249,49 @@ class MemoryBank(object):
 
 
 
+class FeatureQueue(object):
+    """
+    FIFO queue of the detached anchor features of previous training steps with their sample indices and targets,
+    used as extra contrast samples so the contrastive batch stays large with small or accumulated batches
+    """
+    def __init__(self, size, device):
+        self.size = size
+        self.device = device
+        self.features = None
+        self.reset()
+
+    def reset(self):
+        self.ptr = 0
+        self.filled = 0
+
+    @torch.no_grad()
+    def enqueue(self, features, inds, targets):
+        features, inds, targets = features[-self.size:], inds[-self.size:], targets[-self.size:]
+        if self.features is None:
+            self.features = torch.zeros(self.size, features.shape[1], device=self.device)
+            self.inds = torch.zeros(self.size, dtype=torch.long, device=self.device)
+            self.targets = torch.zeros(self.size, dtype=torch.long, device=self.device)
+        pos = (self.ptr + torch.arange(len(features), device=self.device)) % self.size
+        self.features[pos] = features.detach().float()
+        self.inds[pos] = inds.to(self.device)
+        self.targets[pos] = targets.to(self.device)
+        self.ptr = (self.ptr + len(features)) % self.size
+        self.filled = min(self.filled + len(features), self.size)
+
+    def get(self):
+        return self.features[:self.filled], self.inds[:self.filled], self.targets[:self.filled]
+
+
 @torch.no_grad()
 def fill_memory_bank(loader, model, memory_bank):
-    model.eval()
-    memory_bank.reset()
-
-    for i, batch in enumerate(loader):
+    # features in dataset order, also when the loader is length bucketed
+    device = next(model.parameters()).device
+    features, targets, _ = extract_features(model, loader, device, feat_dim=memory_bank.dim)
+    fill_memory_bank_from_features(features, targets, memory_bank)
 
-        batch = tuple(t.cuda(non_blocking=True) for t in batch)
-        input_ids, input_mask, segment_ids, label_ids = batch
-        X = {"input_ids":input_ids, "attention_mask": input_mask, "token_type_ids": segment_ids}
-        feature = model(X, output_hidden_states=True)["hidden_states"]
 
-        memory_bank.update(feature, label_ids)
-        if i % 20 == 0:
-            print('Fill Memory Bank [%d/%d]' %(i, len(loader)))
\ No newline at end of file
+def fill_memory_bank_from_features(features, targets, memory_bank):
+    """fill the memory bank with already extracted features, e.g. the embedding snapshot of the current round"""
+    memory_bank.reset()
+    memory_bank.update(features.float(), targets)
+    print('Fill Memory Bank [%d/%d] from extracted features' %(memory_bank.ptr, memory_bank.n))
@@ -0,0 +1,74 @@
+"""
+Clustering metrics with vectorized confusion matrices.
+Confusion matrices follow hungray_aligment: w[pred, true] counts the samples of class true assigned to cluster pred.
+"""
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from sklearn.metrics import normalized_mutual_info_score, adjusted_rand_score
+
+
+def confusion_matrices(y_trues, y_preds, D):
+    """(P, D, D) confusion matrices of P (y_true, y_pred) pairs, built with a single np.bincount"""
+    offsets = [np.full(len(y_true), p * D * D, dtype=np.int64) for p, y_true in enumerate(y_trues)]
+    codes = np.concatenate(offsets) + np.concatenate(y_preds).astype(np.int64) * D + np.concatenate(y_trues).astype(np.int64)
+    return np.bincount(codes, minlength=len(y_trues) * D * D).reshape(len(y_trues), D, D).astype(np.float64)
+
+
+def hungarian_alignment(y_true, y_pred):
+    """optimal one-to-one matching between clusters and classes, returns (ind, w) like hungray_aligment"""
+    size = min(y_pred.size, y_true.size)
+    y_true, y_pred = y_true[:size], y_pred[:size]
+    D = max(y_pred.max(), y_true.max()) + 1
+    w = confusion_matrices([y_true], [y_pred], D)[0]
+    ind = np.transpose(np.asarray(linear_sum_assignment(w.max() - w)))
+    return ind, w
+
+
+def batch_accuracy_scores(y_trues, y_preds, known_lab):
+    """
+    Acc / Known / Novel of many (y_true, y_pred) pairs: the confusion matrices of all pairs are built at once,
+    only the Hungarian matching runs per pair, then the matched counts and class sizes are reduced with vectorized sums.
+    Novel classes are range(#classes in y_true) without known_lab, as in clustering_accuracy_score.
+    """
+    sizes = [min(y_pred.size, y_true.size) for y_true, y_pred in zip(y_trues, y_preds)]
+    y_trues = [np.asarray(y_true)[:size] for y_true, size in zip(y_trues, sizes)]
+    y_preds = [np.asarray(y_pred)[:size] for y_pred, size in zip(y_preds, sizes)]
+    Ds = [max(y_pred.max(), y_true.max()) + 1 for y_true, y_pred in zip(y_trues, y_preds)]
+    D = max(Ds)
+    w = confusion_matrices(y_trues, y_preds, D)
+
+    # matched[p, j]: samples of class j in the cluster matched to it
+    matched = np.zeros((len(w), D))
+    for p in range(len(w)):
+        # match on each pair's own D x D matrix so ties are broken as in hungray_aligment
+        w_p = w[p, :Ds[p], :Ds[p]]
+        rows, cols = linear_sum_assignment(w_p.max() - w_p)
+        matched[p, cols] = w_p[rows, cols]
+    class_sizes = w.sum(axis=1)
+
+    known = np.zeros((len(w), D), dtype=bool)
+    known[:, [k for k in known_lab if k < D]] = True
+    num_classes = np.array([len(np.unique(y_true)) for y_true in y_trues])
+    novel = (np.arange(D)[None, :] < num_classes[:, None]) & ~known
+
+    acc = matched.sum(axis=1) / np.array(sizes)
+    total_known = (class_sizes * known).sum(axis=1)
+    total_novel = (class_sizes * novel).sum(axis=1)
+    old_acc = np.divide((matched * known).sum(axis=1), total_known, out=np.zeros(len(w)), where=total_known > 0)
+    new_acc = np.divide((matched * novel).sum(axis=1), total_novel, out=np.zeros(len(w)), where=total_novel > 0)
+    return [(round(a * 100, 2), round(o * 100, 2), round(n * 100, 2)) for a, o, n in zip(acc, old_acc, new_acc)]
+
+
+def batch_clustering_scores(y_trues, y_preds, known_lab):
+    """clustering_score of many (y_true, y_pred) pairs in one call, e.g. all seeds or settings of a sweep"""
+    scores = []
+    for y_true, y_pred, (Acc, Known, Novel) in zip(y_trues, y_preds, batch_accuracy_scores(y_trues, y_preds, known_lab)):
+        scores.append({
+            'Acc': Acc,
+            'NMI': round(normalized_mutual_info_score(y_true, y_pred)*100, 2),
+            'ARI': round(adjusted_rand_score(y_true, y_pred)*100, 2),
+            'H-Score': round(2 * Known * Novel / (Known + Novel), 2) if Known + Novel > 0 else 0.0,
+            'Known': Known,
+            'Novel': Novel
+        })
+    return scores
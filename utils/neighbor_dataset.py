@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 from torch.utils.data import Dataset
+from torch.utils.data._utils.collate import default_collate
 from transformers import AutoTokenizer
 from heapq import nlargest
 import openai
@@ -8,11 +9,34 @@ import time
 import re
 import json
 import os
-from together import Together
+from utils.llm import chat_completion, run_concurrently
+from utils.llm_cache import get_llm_cache
+from utils.llm_telemetry import get_llm_telemetry
+from utils.batching import trim_padding
+
+def neighbor_collate(batch, dynamic_padding=False):
+    """
+    collate NeighborsDataset items, the cluster indices stay lists since they can be None.
+    Module level (used with functools.partial) so DataLoader workers can pickle it.
+    """
+    batch_dict = {}
+    for key in batch[0]:
+        if key in ['pos_cluster_idx', 'neg_cluster_idx']:
+            batch_dict[key] = [d[key] for d in batch]
+        else:
+            batch_dict[key] = default_collate([d[key] for d in batch])
+        if key in ['anchor', 'neighbor'] and dynamic_padding:
+            batch_dict[key] = list(trim_padding(*batch_dict[key]))
+    return batch_dict
+
 
 class NeighborsDataset(Dataset):
+    """
+    All LLM feedback is resolved in resolve_feedback when the dataset is built, __getitem__ only reads it,
+    so the dataset can be served by DataLoader worker processes.
+    """
     def __init__(self, args, dataset, indices, query_index, pred, p, cluster_name=None, num_neighbors=None,
-                di_all=None, di_all_pos_cluster_idx=None, di_all_neg_cluster_idx=None):
+                di_all=None, di_all_pos_cluster_idx=None, di_all_neg_cluster_idx=None, tokenizer=None):
         super(NeighborsDataset, self).__init__()
         self.args = args
         self.dataset = dataset
@@ -20,7 +44,7 @@ class NeighborsDataset(Dataset):
         self.query_index = query_index
         if num_neighbors is not None:
             self.indices = self.indices[:, :num_neighbors+1]
-        self.tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        self.tokenizer = tokenizer if tokenizer is not None else AutoTokenizer.from_pretrained(args.tokenizer)
         self.pred = pred
         self.count = 0
         self.di = {}
@@ -41,28 +65,164 @@ class NeighborsDataset(Dataset):
 
         self.p = p
         self.cluster_name = cluster_name 
+        self.build_cluster_index()
+        self.resolve_feedback()
 
     def __len__(self):
         return len(self.dataset)
 
+    def build_cluster_index(self):
+        """
+        Cluster -> member indices in CSR form: the members of cluster c are cluster_members[cluster_offsets[c]:cluster_offsets[c + 1]],
+        in ascending order like np.where(pred == c)[0]. is_query marks the query samples of this round.
+        """
+        pred = np.asarray(self.pred)
+        self.cluster_members = np.argsort(pred, kind='stable')
+        self.cluster_offsets = np.concatenate([[0], np.cumsum(np.bincount(pred, minlength=self.p.shape[1]))])
+        self.is_query = np.zeros(len(self.dataset), dtype=bool)
+        self.is_query[np.asarray(self.query_index, dtype=np.int64)] = True
+
+    def cluster_candidates(self, c):
+        return self.cluster_members[self.cluster_offsets[c]:self.cluster_offsets[c + 1]]
+
+    def resolve_feedback(self):
+        """
+        Gather every query anchor, send the LLM prompts concurrently and fill the feedback dictionaries
+        before training begins, so that __getitem__ only does dictionary lookups.
+        """
+        start = time.time()
+        if self.args.running_method not in ['Loop', 'GCD', 'SimGCD', 'BaCon']:
+            jobs = []
+            for index in self.query_index:
+                index = int(index)
+                if index in self.di:
+                    continue
+                # For the selected samples, query llm to select the most similar sample from the neighboring clusters
+                prob_tensor = self.p[index, :]
+                topk_probs, topk_indices = torch.topk(prob_tensor, self.args.options, dim=-1)
+                qs = [np.random.choice(self.cluster_candidates(topk_indices[i].item()), 1)[0] for i in range(self.args.options)]
+                if self.args.weight_cluster_instance_cl > 0:
+                    # query llm to assign the anchor to one of the topk clusters based on category names and descriptions
+                    k = int(np.floor(self.args.options_cluster_instance_ratio * len(self.cluster_name)))
+                    topk_probs, topk_cat_indices = torch.topk(prob_tensor, k, dim=-1)
+                else:
+                    topk_cat_indices = None
+                self.di[index] = None
+                jobs.append((index, qs, topk_cat_indices))
+            results = self.select_neighbors([(index, qs) for index, qs, _ in jobs])
+            if self.args.weight_cluster_instance_cl > 0:
+                results_c = self.run_concurrently(self.query_anchor_cluster, [(index, topk_cat_indices) for index, _, topk_cat_indices in jobs])
+            else:
+                results_c = [(None, None)] * len(jobs)
+
+            for (index, qs, topk_cat_indices), (neighbor_index, confidence), (pos_cluster_idx, confidence_c) in zip(jobs, results, results_c):
+                if self.args.flag_filtering:
+                    # filter out the LLM feedback with confidence less than a threshold
+                    if float(confidence) < self.args.filter_threshold:
+                        neighbor_index = np.random.choice(self.indices[index], 1)[0]
+
+                self.di[index] = neighbor_index
+                self.di_all[index] = neighbor_index
+
+                neg_cluster_idx = None
+                if self.args.weight_cluster_instance_cl > 0:
+                    neg_cluster_idx = topk_cat_indices[topk_cat_indices != pos_cluster_idx]
+
+                    if self.args.flag_filtering_c:
+                        # filter out the LLM feedback with confidence less than a threshold
+                        if float(confidence_c) < self.args.filter_threshold_c:
+                            pos_cluster_idx = None
+                            neg_cluster_idx = None
+
+                    self.di_all_pos_cluster_idx[index] = pos_cluster_idx
+                    self.di_all_neg_cluster_idx[index] = neg_cluster_idx
+                else:
+                    pos_cluster_idx = None
+
+                self.di_pos_cluster_idx[index] = pos_cluster_idx
+                self.di_neg_cluster_idx[index] = neg_cluster_idx
+        else:
+            ## Generalized Loop
+            jobs = []
+            if self.args.running_method not in ['GCD', 'SimGCD']:
+                for index in self.query_index:
+                    index = int(index)
+                    if index in self.di:
+                        continue
+                    neighbor_pred = np.take(self.pred, self.indices[index, :])
+                    # unique prediction
+                    res = [neighbor_pred[0]]
+                    for i in neighbor_pred[1:]:
+                        if i not in res:
+                            res.append(i)
+                            break
+                    if len(res) == 1:
+                        continue
+                    # For the selected samples, randomly select a sample from its top neighboring clusters
+                    # Generalize to the case # querying neighbors / options >= 2
+                    qs = [np.random.choice(self.indices[index, np.where(neighbor_pred==res[i])][0], 1)[0] for i in range(self.args.options)]
+                    self.di[index] = None
+                    jobs.append((index, qs))
+            results = self.select_neighbors(jobs)
+
+            for (index, qs), (neighbor_index, confidence) in zip(jobs, results):
+                if self.args.flag_filtering:
+                    # filter out the LLM feedback with confidence less than a threshold
+                    if float(confidence) < self.args.filter_threshold:
+                        neighbor_index = np.random.choice(self.indices[index], 1)[0]
+                self.di[index] = neighbor_index
+
+        self.count += len(jobs)
+        print(f'\nResolved LLM feedback for {len(jobs)} query samples in {time.time() - start:.2f}s (concurrency: {self.args.llm_concurrency})')
+        if get_llm_cache(self.args) is not None:
+            print('LLM Cache:', get_llm_cache(self.args).stats())
+
+    def run_concurrently(self, fn, jobs):
+        """run fn(*job, count) for every job with at most args.llm_concurrency requests in flight, keeping the job order"""
+        return run_concurrently(fn, [(*job, self.count + i) for i, job in enumerate(jobs)], self.args.llm_concurrency)
+
+    def record_failure(self, site, choices_content):
+        """a failed request counts as a fallback, an answer that could not be parsed as a parse failure"""
+        if choices_content is None:
+            get_llm_telemetry(self.args).record_fallback(site)
+        else:
+            get_llm_telemetry(self.args).record_parse_failure(site)
+
+    def select_neighbors(self, jobs):
+        """query llm to select the most similar candidate for every (index, qs) job, packing args.llm_batch_queries anchors per request"""
+        batch_size = self.args.llm_batch_queries
+        if batch_size <= 1 or self.api_key is None or self.args.running_method == 'GCDLLMs_w_cluster_alignment':
+            return self.run_concurrently(self.query_llm_gen, jobs)
+
+        chunks = [jobs[i:i + batch_size] for i in range(0, len(jobs), batch_size)]
+        results = [r for chunk_results in self.run_concurrently(self.query_llm_gen_batch, [(chunk,) for chunk in chunks]) for r in chunk_results]
+
+        # fall back to per-item requests for the entries that could not be parsed
+        failed = [i for i, r in enumerate(results) if r is None]
+        if len(failed) > 0:
+            print(f'Batched neighbor selection: {len(failed)}/{len(jobs)} entries unparsed, falling back to per-item requests')
+            for i, r in zip(failed, self.run_concurrently(self.query_llm_gen, [jobs[i] for i in failed])):
+                results[i] = r
+        return results
+
+    def query_anchor_cluster(self, index, topk_cat_indices, count):
+        """query llm to assign one anchor to one of its topk clusters"""
+        anchor_text = self.tokenizer.decode(self.dataset.__getitem__(index)[0], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        topk_cluster_name = [self.cluster_name[i.item()] for i in topk_cat_indices]
+        pos_cluster_idx, confidence_c = self.query_llm_cluster_instance(anchor_text, topk_cluster_name, topk_cat_indices, count)
+        if count < 6:
+            print(f"\nAnchor: {anchor_text} \nPositive Cluster Name: {self.cluster_name[pos_cluster_idx]}")
+        return pos_cluster_idx, confidence_c
+
     def __getitem__(self, index):
         output = {}
         anchor = list(self.dataset.__getitem__(index))
-        neighbor_pred = np.take(self.pred, self.indices[index, :])
-
-        # unique prediction
-        res = [neighbor_pred[0]]
-        for i in neighbor_pred[1:]:
-            if i not in res:
-                res.append(i)
-                break
-
 
         pos_cluster_idx = None
         neg_cluster_idx = None
         if self.args.running_method not in ['Loop', 'GCD', 'SimGCD', 'BaCon']:
             ## Ours
-            if index not in self.query_index:
+            if not self.is_query[index]:
                 if self.di_all.get(index, -1) == -1:
                     # For the unselected samples, randomly select a sample from their neighbors
                     neighbor_index = np.random.choice(self.indices[index], 1)[0]
@@ -72,82 +232,20 @@ class NeighborsDataset(Dataset):
                     if self.args.weight_cluster_instance_cl > 0:
                         pos_cluster_idx = self.di_all_pos_cluster_idx[index]
                         neg_cluster_idx = self.di_all_neg_cluster_idx[index]
-
             else:
-                # For the selected samples, query llm to select the most similar sample from the neighboring clusters
-                anchor_text = self.tokenizer.decode(anchor[0], skip_special_tokens=True, clean_up_tokenization_spaces=True)
-                if self.di.get(index, -1) == -1:
-                    prob_tensor = self.p[index, :]
-                    topk_probs, topk_indices = torch.topk(prob_tensor, self.args.options, dim=-1)
-                    qs = [np.random.choice(np.where(self.pred==topk_indices[i].item())[0], 1)[0] for i in range(self.args.options)]
-                    # neighbor_index = self.query_llm_gen(index, qs)
-                    neighbor_index, confidence = self.query_llm_gen(index, qs)
-
-                    if self.args.flag_filtering:
-                        # filter out the LLM feedback with confidence less than a threshold
-                        if float(confidence) < self.args.filter_threshold:
-                            neighbor_index = np.random.choice(self.indices[index], 1)[0]
-
-                    self.di[index] = neighbor_index
-                    self.di_all[index] = neighbor_index
-                    
-
-                    if self.args.weight_cluster_instance_cl > 0:
-                        # query llm to assign the anchor to one of the topk clusters based on category names and descriptions
-                        k = int(np.floor(self.args.options_cluster_instance_ratio * len(self.cluster_name)))
-                        topk_probs, topk_indices = torch.topk(prob_tensor, k, dim=-1)
-                        topk_cluster_name = [self.cluster_name[i.item()] for i in topk_indices]
-                        pos_cluster_idx, confidence = self.query_llm_cluster_instance(anchor_text, topk_cluster_name, topk_indices)
-                        neg_cluster_idx = topk_indices[topk_indices != pos_cluster_idx]
-
-                        if self.count < 6:
-                            print(f"\nAnchor: {anchor_text} \nPositive Cluster Name: {self.cluster_name[pos_cluster_idx]}")
-                        
-                        if self.args.flag_filtering_c:
-                            # filter out the LLM feedback with confidence less than a threshold
-                            if float(confidence) < self.args.filter_threshold_c:
-                                pos_cluster_idx = None
-                                neg_cluster_idx = None
-
-                        self.di_all_pos_cluster_idx[index] = pos_cluster_idx
-                        self.di_all_neg_cluster_idx[index] = neg_cluster_idx
-
-                    self.di_pos_cluster_idx[index] = pos_cluster_idx
-                    self.di_neg_cluster_idx[index] = neg_cluster_idx
-                    self.count += 1
-
-                else:
-                    neighbor_index = self.di[index]
-                    if self.args.weight_cluster_instance_cl > 0:
-                        pos_cluster_idx = self.di_pos_cluster_idx[index]
-                        neg_cluster_idx = self.di_neg_cluster_idx[index]
+                # For the selected samples, use the LLM feedback resolved in resolve_feedback
+                neighbor_index = self.di[index]
+                if self.args.weight_cluster_instance_cl > 0:
+                    pos_cluster_idx = self.di_pos_cluster_idx[index]
+                    neg_cluster_idx = self.di_neg_cluster_idx[index]
 
         else:
             ## Generalized Loop
-            # For the unselected samples, randomly select a sample from their neighbors
-            if len(res) == 1 or index not in self.query_index or self.args.running_method in ['GCD', 'SimGCD']:
+            if index not in self.di:
+                # For the unselected samples, randomly select a sample from their neighbors
                 neighbor_index = np.random.choice(self.indices[index], 1)[0]
             else:
-                # For the selected samples, randomly select a sample from its top neighboring clusters
-                # Generalize to the case # querying neighbors / options >= 2
-                qs = [np.random.choice(self.indices[index, np.where(neighbor_pred==res[i])][0], 1)[0] for i in range(self.args.options)]
-
-                if self.di.get(index, -1) == -1:
-                    # Generalize to the case # querying neighbors / options >= 2
-                    # neighbor_index = self.query_llm_gen(index, qs)
-                    neighbor_index, confidence = self.query_llm_gen(index, qs)
-
-                    if self.args.flag_filtering:
-                        # filter out the LLM feedback with confidence less than a threshold
-                        if float(confidence) < self.args.filter_threshold:
-                            neighbor_index = np.random.choice(self.indices[index], 1)[0]
-                            self.di[index] = neighbor_index
-
-                    self.di[index] = neighbor_index
-                    self.count += 1
-                else:
-                    neighbor_index = self.di[index]
-        
+                neighbor_index = self.di[index]
     
         neighbor = self.dataset.__getitem__(neighbor_index)
         output['anchor'] = anchor[:3]
@@ -155,13 +253,14 @@ class NeighborsDataset(Dataset):
         output['possible_neighbors'] = torch.from_numpy(self.indices[index]) # used for neighbor contrastive learning
         output['target'] = anchor[-1]
         output['index'] = index
+        output['neighbor_index'] = int(neighbor_index)
         output['pos_cluster_idx'] = pos_cluster_idx
         output['neg_cluster_idx'] = neg_cluster_idx
 
         return output
     
     
-    def query_llm_gen(self, q, qs):
+    def query_llm_gen(self, q, qs, count=0):
         s = self.tokenizer.decode(self.dataset.__getitem__(q)[0], skip_special_tokens=True, clean_up_tokenization_spaces=True)
         sqs = [self.tokenizer.decode(self.dataset.__getitem__(q)[0], skip_special_tokens=True, clean_up_tokenization_spaces=True) for q in qs]
         
@@ -181,60 +280,18 @@ class NeighborsDataset(Dataset):
         for i, sq in enumerate(sqs):
             prompt += f"\nChoice {i + 1}: {sq}"
 
-        if self.count < 5:
-            print(f"\nPositive Neighbor Selection Prompt Example: {self.count}\n", prompt)
+        if count < 5:
+            print(f"\nPositive Neighbor Selection Prompt Example: {count}\n", prompt)
 
         if self.api_key is None:
             return qs[0]
         if self.args.running_method == 'GCDLLMs_w_cluster_alignment':
             return qs[0]
+        choices_content = None
         try:
-            if 'gpt' not in self.args.llm:
-                os.environ["TOGETHER_API_KEY"] = self.args.api_key
-                client = Together()
-
-                max_retries = 5
-                retry_delay = 1  # Wait for 1 seconds before retrying
-                for attempt in range(max_retries):
-                    try:
-                        completion = client.chat.completions.create(
-                            model=self.args.llm,
-                            messages=[
-                                {"role": "system", "content": "You are a helpful assistant."},
-                                {"role": "user", "content": prompt}
-                            ],
-                            temperature=0.0,
-                            top_p=1.0,
-                            n=1,
-                            max_tokens=50
-                        )
-                        choices_content = completion.choices[0].message.content
-                        break  # If successful, break out of the loop
-                    except Exception as e:
-                        if attempt < max_retries - 1:
-                            print(f"Attempt {attempt + 1} failed: {e}. Retrying in {retry_delay} seconds...")
-                            time.sleep(retry_delay)
-                        else:
-                            print(f"Attempt {attempt + 1} failed: {e}. No more retries left.")
-                            raise e # Re-raise the exception to handle it outside the loop
-
-
-            else:
-                completion = openai.ChatCompletion.create(
-                    model=self.args.llm,  # 'gpt-4o-mini', # "gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.0,  # Set to 0 to remove randomness
-                    top_p=1.0,        # Use top_p sampling with the full range of tokens
-                    n=1,               # Number of responses to generate
-                    max_tokens=50     # Set a lower max_tokens value to limit response length and avoid timeout
-                )
-                # Check the choices dynamically
-                choices_content = completion.choices[0].message['content']
-            if self.count < 5:
-                print(f"\nPositive Neighbor Selection Completion Example: {self.count}\n", choices_content)
+            choices_content = chat_completion(self.args, prompt, site='neighbor_selection')
+            if count < 5:
+                print(f"\nPositive Neighbor Selection Completion Example: {count}\n", choices_content)
             for i in range(len(sqs)):
                 choice_str = f'Choice {i + 1}'
                 # Match ' Choice X' at the start or followed by a colon and any characters
@@ -253,10 +310,54 @@ class NeighborsDataset(Dataset):
 
         except Exception as e:
             print(e)  # This will print the actual exception message
+            self.record_failure('neighbor_selection', choices_content)
             return qs[0], 0.0
 
 
-    def query_llm_cluster_instance(self, anchor_text, topk_cluster_name, topk_cat_indices):
+    def query_llm_gen_batch(self, items, count=0):
+        """
+        Select the most similar candidate for several anchors with one request: the instruction and the demonstration
+        block are sent once for all (q, qs) items. Returns one (neighbor_index, confidence) per item, or None for the
+        items whose answer could not be parsed.
+        """
+        # Construct the base of the prompt
+        prompt = f"For each Query below, select the utterance among its choices that better corresponds with the Query in terms of {self.args.task}. "
+        prompt += "\n Also show your confidence by providing a probability between 0 and 1."
+        prompt += "\n Please respond with one line per query in the format 'Query [number]: Choice [number], Confidence: [number]' without explanation, e.g., 'Query 1: Choice 1, Confidence: 0.7', 'Query 2: Choice 3, Confidence: 0.9', etc.\n"
+
+        # Add demonstration in the format of Text: [text], Label: [label]
+        if self.args.flag_demo:
+            prompt += self.args.prompt_demo
+
+        # Add the queries and their choices dynamically
+        for k, (q, qs) in enumerate(items):
+            prompt += f"\n\nQuery {k + 1}: " + self.tokenizer.decode(self.dataset.__getitem__(q)[0], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+            for i, sq in enumerate(qs):
+                prompt += f"\nChoice {i + 1}: " + self.tokenizer.decode(self.dataset.__getitem__(sq)[0], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+
+        if count < 1:
+            print(f"\nBatched Positive Neighbor Selection Prompt Example: {count}\n", prompt)
+
+        results = [None] * len(items)
+        try:
+            choices_content = chat_completion(self.args, prompt, max_tokens=20 * len(items) + 30, site='neighbor_selection_batch')
+        except Exception as e:
+            print(e)  # This will print the actual exception message
+            get_llm_telemetry(self.args).record_fallback('neighbor_selection_batch', len(items))
+            return results
+        if count < 1:
+            print(f"\nBatched Positive Neighbor Selection Completion Example: {count}\n", choices_content)
+
+        for match in re.finditer(r'Query (\d+)\s*:\s*Choice (\d+)\b.*?Confidence: (\d+(\.\d+)?)', choices_content):
+            k, i = int(match.group(1)) - 1, int(match.group(2)) - 1
+            if 0 <= k < len(items) and 0 <= i < len(items[k][1]) and results[k] is None:
+                results[k] = (items[k][1][i], match.group(3))
+        if results.count(None) > 0:
+            get_llm_telemetry(self.args).record_parse_failure('neighbor_selection_batch', results.count(None))
+        return results
+
+
+    def query_llm_cluster_instance(self, anchor_text, topk_cluster_name, topk_cat_indices, count=0):
 
         # Construct the base of the prompt
         prompt = f"Select the category that better corresponds with the Query in terms of {self.args.task}. "
@@ -274,58 +375,16 @@ class NeighborsDataset(Dataset):
         for i, cluster_name in enumerate(topk_cluster_name):
             prompt += f"\nChoice {i + 1}: {cluster_name}"
 
-        if self.count < 5:
-            print(f"\nCluster Description Selection Prompt Example: {self.count}\n ", prompt)
+        if count < 5:
+            print(f"\nCluster Description Selection Prompt Example: {count}\n ", prompt)
         
         if self.api_key is None:
             return topk_cat_indices[0]
+        choices_content = None
         try:
-            if 'gpt' not in self.args.llm:
-                os.environ["TOGETHER_API_KEY"] = self.args.api_key
-                client = Together()
-
-                max_retries = 5
-                retry_delay = 1  # Wait for 1 seconds before retrying
-                for attempt in range(max_retries):
-                    try:
-                        completion = client.chat.completions.create(
-                            model=self.args.llm,
-                            messages=[
-                                {"role": "system", "content": "You are a helpful assistant."},
-                                {"role": "user", "content": prompt}
-                            ],
-                            temperature=0.0,
-                            top_p=1.0,
-                            n=1,
-                            max_tokens=50
-                        )
-                        choices_content = completion.choices[0].message.content
-                        break  # If successful, break out of the loop
-                    except Exception as e:
-                        if attempt < max_retries - 1:
-                            print(f"Attempt {attempt + 1} failed: {e}. Retrying in {retry_delay} seconds...")
-                            time.sleep(retry_delay)
-                        else:
-                            print(f"Attempt {attempt + 1} failed: {e}. No more retries left.")
-                            raise e # Re-raise the exception to handle it outside the loop
-                            
-
-            else:
-                completion = openai.ChatCompletion.create(
-                    model=self.args.llm,  # 'gpt-4o-mini', # "gpt-3.5-turbo",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.0,  # Set to 0 to remove randomness
-                    top_p=1.0,        # Use top_p sampling with the full range of tokens
-                    n=1,               # Number of responses to generate
-                    max_tokens=50     # Set a lower max_tokens value to limit response length and avoid timeout
-                )
-                # Check the choices dynamically
-                choices_content = completion.choices[0].message['content']
-            if self.count < 5:
-                print(f"\nCluster Description Selection Completion Example: {self.count} \n", choices_content)
+            choices_content = chat_completion(self.args, prompt, site='cluster_instance')
+            if count < 5:
+                print(f"\nCluster Description Selection Completion Example: {count} \n", choices_content)
             for i in range(len(topk_cat_indices)):
                 choice_str = f'Choice {i + 1}'
                 # Match ' Choice X' at the start or followed by a colon and any characters
@@ -344,4 +403,5 @@ class NeighborsDataset(Dataset):
 
         except Exception as e:
             print(e)  # This will print the actual exception message
+            self.record_failure('cluster_instance', choices_content)
             return topk_cat_indices[0], 0.0
\ No newline at end of file
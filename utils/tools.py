@@ -18,6 +18,9 @@ from scipy.optimize import linear_sum_assignment
 import torch
 import numpy as np
 import gc
+import tempfile
+from utils.metrics import hungarian_alignment, batch_accuracy_scores, batch_clustering_scores
+from utils.batching import LengthBucketSampler
 from sentence_transformers import SentenceTransformer, util
 import torch.backends.cudnn as cudnn
 
@@ -28,50 +31,76 @@ def set_seed(seed):
     cudnn.deterministic = True
     cudnn.benchmark = True
 
-def hungray_aligment(y_true, y_pred):
-    D = max(y_pred.max(), y_true.max()) + 1
-    w = np.zeros((D, D))
-    size = min(y_pred.size, y_true.size)
-    for i in range(size):
-        w[y_pred[i], y_true[i]] += 1
+def get_amp_dtype(name):
+    """map fp32|bf16|fp16 to the autocast dtype, None for full precision"""
+    amp_dtypes = {'fp32': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+    if name not in amp_dtypes:
+        raise NotImplementedError(f"Precision {name} not chosen from {list(amp_dtypes.keys())}")
+    return amp_dtypes[name]
+
+@torch.no_grad()
+def extract_features(model, dataloader, device, feat_dim=None, num_logits=None, amp_dtype=None, memmap_dir=None):
+    """
+    Run the model over the dataloader and gather the CLS hidden states, labels and logits into buffers
+    preallocated from len(dataloader.dataset), optionally under autocast with amp_dtype.
+    With memmap_dir, the features are streamed to a memory-mapped .npy file instead of device memory.
+    Batches of a (non-shuffled) LengthBucketSampler are scattered back to dataset order.
+    Returns (features, labels, logits); features / logits are None when feat_dim / num_logits is None.
+    """
+    model.eval()
+    batch_rows = None
+    if isinstance(dataloader.batch_sampler, LengthBucketSampler):
+        if dataloader.batch_sampler.shuffle:
+            raise ValueError('extract_features needs a deterministic batch order, the length bucketing sampler must not shuffle')
+        batch_rows = iter(list(dataloader.batch_sampler))
+    n = len(dataloader.dataset)
+    features, logits = None, None
+    if feat_dim is not None:
+        if memmap_dir is not None:
+            os.makedirs(memmap_dir, exist_ok=True)
+            fd, path = tempfile.mkstemp(suffix='.npy', dir=memmap_dir)
+            os.close(fd)
+            features = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n, feat_dim))
+            os.unlink(path) # the file is released once the memmap is garbage collected
+        else:
+            features = torch.empty((n, feat_dim), dtype=torch.float32, device=device)
+    labels = torch.empty(n, dtype=torch.long, device=device)
+    if num_logits is not None:
+        logits = torch.empty((n, num_logits), dtype=torch.float32, device=device)
+
+    ptr = 0
+    for batch in dataloader:
+        batch = tuple(t.to(device) for t in batch)
+        input_ids, input_mask, segment_ids, label_ids = batch
+        X = {"input_ids":input_ids, "attention_mask": input_mask, "token_type_ids": segment_ids}
+        with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            outputs = model(X, output_hidden_states=feat_dim is not None)
+
+        b = input_ids.size(0)
+        rows = slice(ptr, ptr+b) if batch_rows is None else np.array(next(batch_rows))
+        if feat_dim is not None:
+            if memmap_dir is not None:
+                features[rows] = outputs["hidden_states"].float().cpu().numpy()
+            else:
+                features[rows] = outputs["hidden_states"]
+        labels[rows] = label_ids
+        if num_logits is not None:
+            logits[rows] = outputs["logits"]
+        ptr += b
 
-    ind = np.transpose(np.asarray(linear_sum_assignment(w.max() - w)))
-    return ind, w
+    if memmap_dir is not None and features is not None:
+        features.flush()
+        features = torch.from_numpy(features)
+    return features, labels, logits
+
+def hungray_aligment(y_true, y_pred):
+    return hungarian_alignment(y_true, y_pred)
 
 def clustering_accuracy_score(y_true, y_pred, known_lab):
-    ind, w = hungray_aligment(y_true, y_pred)
-    acc = sum([w[i, j] for i, j in ind]) / y_pred.size
-    ind_map = {j: i for i, j in ind}
-    
-    old_acc = 0
-    total_old_instances = 0
-    for i in known_lab:
-        old_acc += w[ind_map[i], i]
-        total_old_instances += sum(w[:, i])
-    old_acc /= total_old_instances
-    
-    new_acc = 0
-    total_new_instances = 0
-    for i in range(len(np.unique(y_true))):
-        if i not in known_lab:
-            new_acc += w[ind_map[i], i]
-            total_new_instances += sum(w[:, i])
-    if total_new_instances == 0:
-        new_acc = 0
-    else:
-        new_acc /= total_new_instances
-    return (round(acc*100, 2), round(old_acc*100, 2), round(new_acc*100, 2))
+    return batch_accuracy_scores([y_true], [y_pred], known_lab)[0]
 
 def clustering_score(y_true, y_pred, known_lab):
-    Acc, Known, Novel = clustering_accuracy_score(y_true, y_pred, known_lab)
-    return {
-            'Acc': Acc,
-            'NMI': round(normalized_mutual_info_score(y_true, y_pred)*100, 2),
-            'ARI': round(adjusted_rand_score(y_true, y_pred)*100, 2),
-            'H-Score': round(2 * Known * Novel / (Known + Novel), 2),
-            'Known': Known,
-            'Novel': Novel
-            }
+    return batch_clustering_scores([y_true], [y_pred], known_lab)[0]
 
 
 def mask_tokens(inputs, tokenizer,\
@@ -107,33 +136,52 @@ def mask_tokens(inputs, tokenizer,\
         # The rest of the time (10% of the time) we keep the masked input tokens unchanged
         return inputs, labels
 
+def get_special_tokens_mask(input_ids, tokenizer):
+    """boolean mask of the special (and padding) tokens of a batch or a whole dataset of input ids"""
+    special_ids = torch.tensor(sorted(set(tokenizer.all_special_ids) | {0}), dtype=input_ids.dtype, device=input_ids.device)
+    return torch.isin(input_ids, special_ids)
+
 class view_generator:
+    """
+    Batched rtr / shuffle augmentations on the device of the input ids, drawing from a seeded torch.Generator.
+    special_tokens_mask: precomputed mask of the special tokens, which are never replaced or moved
+    """
     def __init__(self, tokenizer, rtr_prob, seed):
         set_seed(seed)
         self.tokenizer = tokenizer
         self.rtr_prob = rtr_prob
-    
-    def random_token_replace(self, ids):
-        mask_id = self.tokenizer.convert_tokens_to_ids(self.tokenizer.mask_token)
-        ids, _ = mask_tokens(ids, self.tokenizer, mlm_probability=0.25)
-        random_words = torch.randint(len(self.tokenizer), ids.shape, dtype=torch.long)
-        indices_replaced = torch.where(ids == mask_id)
-        ids[indices_replaced] = random_words[indices_replaced]
-        return ids
-
-    def shuffle_tokens(self, ids):
-        view_pos = []
-        for inp in torch.unbind(ids):
-            new_ids = copy.deepcopy(inp)
-            special_tokens_mask = self.tokenizer.get_special_tokens_mask(inp, already_has_special_tokens=True)
-            sent_tokens_inds = np.where(np.array(special_tokens_mask) == 0)[0]
-            inds = np.arange(len(sent_tokens_inds))
-            np.random.shuffle(inds)
-            shuffled_inds = sent_tokens_inds[inds]
-            inp[sent_tokens_inds] = new_ids[shuffled_inds]
-            view_pos.append(new_ids)
-        view_pos = torch.stack(view_pos, dim=0)
-        return view_pos
+        self.seed = seed
+        self.generators = {}
+
+    def get_generator(self, device):
+        # one generator per device, as the random draws must happen on the device of the ids
+        if device not in self.generators:
+            self.generators[device] = torch.Generator(device=device).manual_seed(self.seed)
+        return self.generators[device]
+
+    def random_token_replace(self, ids, special_tokens_mask=None):
+        """
+        select the non-special tokens with probability rtr_prob and replace 90% of the selected ones with random tokens
+        (the mask-then-replace of mask_tokens), i.e. replace every non-special token with probability 0.9 * rtr_prob
+        """
+        if special_tokens_mask is None:
+            special_tokens_mask = get_special_tokens_mask(ids, self.tokenizer)
+        generator = self.get_generator(ids.device)
+        replaced = (torch.rand(ids.shape, generator=generator, device=ids.device) < 0.9 * self.rtr_prob) & ~special_tokens_mask
+        random_words = torch.randint(len(self.tokenizer), ids.shape, generator=generator, device=ids.device, dtype=ids.dtype)
+        return torch.where(replaced, random_words, ids)
+
+    def shuffle_tokens(self, ids, special_tokens_mask=None):
+        """shuffle the non-special tokens of every row with random-key argsort, the special tokens stay in place"""
+        if special_tokens_mask is None:
+            special_tokens_mask = get_special_tokens_mask(ids, self.tokenizer)
+        generator = self.get_generator(ids.device)
+        # random keys for the non-special tokens, special tokens sorted after them in their original order
+        keys = torch.rand(ids.shape, generator=generator, device=ids.device).masked_fill(special_tokens_mask, 2.0)
+        order = torch.argsort(keys, dim=1, stable=True)
+        # non-special positions in ascending order, followed by the special positions
+        slots = torch.argsort(special_tokens_mask.to(torch.uint8), dim=1, stable=True)
+        return torch.empty_like(ids).scatter_(1, slots, ids.gather(1, order))
 
 def measure_interpretability(predictions, references, args):
     ## Compute Similarity Matrix